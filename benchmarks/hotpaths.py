@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures hot paths of downloads plugin in throwaway Trac environment on
+SQLite seeded with given numbers of downloads. Database schema is created
+by plugin's upgrade scripts, platforms, types and downloads are added
+through DownloadsApi. If multiproject package is not installed, a stub of
+its configuration is used instead. Results are written as JSON.
+
+Usage: python benchmarks/hotpaths.py [--sizes 100,1000,10000] [--repeats 50]
+  [--output results.json] [--keep]
+"""
+
+# Standard imports.
+import os, sys, time, types, random, shutil, tempfile, traceback
+from datetime import datetime
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Number of downloads which have a file stored on disk.
+stored_files = 100
+
+# Size of each stored file in bytes.
+file_size = 64 * 1024
+
+def install_multiproject_stub():
+    """
+    Installs modules standing in for multiproject configuration and
+    database helpers used by the plugin. Downloads are stored in downloads
+    subdirectory of each environment.
+    """
+    try:
+        import multiproject.core.configuration, multiproject.core.db
+        return False
+    except ImportError:
+        pass
+
+    class User(object):
+        id = 1
+
+    class UserStore(object):
+        def getUser(self, username):
+            return User()
+
+    class Configuration(object):
+        def getEnvironmentDownloadsPath(self, env):
+            return os.path.join(env.path, 'downloads')
+
+        def getEnvironmentDownloadsUrl(self, env, path):
+            return '/downloads/' + path
+
+        def getUserStore(self):
+            return UserStore()
+
+    def safe_int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    modules = {}
+    for name in ('multiproject', 'multiproject.core',
+      'multiproject.core.configuration', 'multiproject.core.db'):
+        modules[name] = sys.modules[name] = types.ModuleType(name)
+    modules['multiproject'].core = modules['multiproject.core']
+    modules['multiproject.core'].configuration = modules['multiproject.core.configuration']
+    modules['multiproject.core'].db = modules['multiproject.core.db']
+    modules['multiproject.core.configuration'].conf = Configuration()
+    modules['multiproject.core.db'].safe_int = safe_int
+    return True
+
+# Stub has to be installed before plugin modules are imported.
+multiproject_stub = install_multiproject_stub()
+
+# Trac imports.
+import trac
+from trac.env import Environment
+from trac.mimeview import Context
+from trac.test import MockPerm
+from trac.util.datefmt import utc, to_timestamp
+from trac.web.api import RequestDone
+from trac.web.href import Href
+from trac.wiki.formatter import Formatter
+
+# Local imports.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracdownloads.api import DownloadsApi, database_context
+from tracdownloads.core import DownloadsCore
+from tracdownloads.timeline import DownloadsTimeline
+from tracdownloads.wiki import DownloadsWiki
+
+class BenchmarkRequest(object):
+    """
+    Minimal request object accepted by plugin's request handlers, wiki
+    macros and timeline provider. Response body is discarded.
+    """
+    def __init__(self, path_info = '/', args = None, headers = None):
+        self.path_info = path_info
+        self.args = args or {}
+        self.headers = headers or {}
+        self.method = 'GET'
+        self.authname = 'anonymous'
+        self.perm = MockPerm()
+        self.href = Href('/')
+        self.abs_href = Href('http://localhost/')
+        self.tz = utc
+        self.locale = None
+        self.session = {}
+        self.chrome = {'links' : {}, 'scripts' : [], 'ctxtnav' : [],
+          'warnings' : [], 'notices' : []}
+        self.status = None
+        self.sent = 0
+
+    def get_header(self, name):
+        return self.headers.get(name.lower())
+
+    def send_response(self, code):
+        self.status = code
+
+    def send_header(self, name, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+    def write(self, data):
+        self.sent += len(data)
+
+def create_environment(path, size):
+    """
+    Creates Trac environment in <path> with <size> downloads.
+    """
+    env = Environment(path, create = True, options = [
+      ('trac', 'database', 'sqlite:db/trac.db'),
+      ('logging', 'log_type', 'none'),
+      ('components', 'tracdownloads.*', 'enabled'),
+      ('downloads', 'query_stats_interval', '0'),
+      ('downloads', 'slow_query_threshold', '0')])
+    api = env[DownloadsApi]
+    context = Context('downloads-benchmark')
+    with database_context(env, context, commit = True):
+        # Platforms and types of db1 are complemented by a few more.
+        for I in xrange(5):
+            api.add_platform(context, {'name' : 'Platform %s' % (I,)})
+            api.add_type(context, {'name' : 'Type %s' % (I,)})
+        platforms = [platform['id'] for platform in api.get_platforms(context)]
+        download_types = [type['id'] for type in api.get_types(context)]
+        components = [component['name'] for component in api.get_components(context)]
+        versions = [version['name'] for version in api.get_versions(context)]
+
+        # Add downloads uploaded during last year.
+        now = to_timestamp(datetime.now(utc))
+        for I in xrange(1, size + 1):
+            api.add_download(context, {'file' : 'release-%s.zip' % (I,),
+              'description' : 'Release %s' % (I,), 'size' : file_size,
+              'time' : now - (size - I) * (365 * 86400 // size), 'count' :
+              random.randint(0, 1000), 'author' : 'user%s' % (I % 10,),
+              'tags' : 'release', 'component' : components and
+              random.choice(components) or None, 'version' : versions and
+              random.choice(versions) or None, 'platform' :
+              random.choice(platforms + [None]), 'type' :
+              random.choice(download_types + [None]), 'featured' :
+              int(I % 50 == 0), 'mimetype' : 'application/zip', 'charset' :
+              None})
+
+        # Store files of a part of downloads.
+        content = 'x' * file_size
+        for download in api.get_downloads(context)[:stored_files]:
+            path = api.storage.get_file_path(download)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            file = open(path, 'wb')
+            try:
+                file.write(content)
+            finally:
+                file.close()
+    return env
+
+def measure(env, function, repeats):
+    """
+    Calls <function> <repeats> times and returns its timing and number of
+    queries and rows per call recorded by DownloadsApi.
+    """
+    stats = env[DownloadsApi].query_stats
+    times = []
+    queries = 0
+    rows = 0
+    for I in xrange(repeats):
+        stats.start_request('/benchmark')
+        start = time.time()
+        function()
+        times.append((time.time() - start) * 1000.0)
+        request = stats.finish_request()
+        queries += request['queries']
+        rows += request['rows']
+    times.sort()
+    return {'mean_ms' : sum(times) / len(times), 'median_ms' :
+      times[len(times) // 2], 'min_ms' : times[0], 'max_ms' : times[-1],
+      'queries' : float(queries) / repeats, 'rows' : float(rows) / repeats}
+
+def get_benchmarks(env, size):
+    """
+    Returns list of benchmarked hot paths as tuples of name and function.
+    """
+    api = env[DownloadsApi]
+    wiki = env[DownloadsWiki]
+    core = env[DownloadsCore]
+    timeline = env[DownloadsTimeline]
+    files = ['release-%s.zip' % (random.randint(1, size),) for I in xrange(100)]
+    stored_ids = range(1, min(size, stored_files) + 1)
+
+    def with_context(function):
+        def call():
+            context = Context('downloads-benchmark')
+            with database_context(env, context):
+                function(context)
+        return call
+
+    def get_file():
+        req = BenchmarkRequest('/downloads/%s' % (random.choice(stored_ids),))
+        core.match_request(req)
+        try:
+            core.process_request(req)
+        except RequestDone:
+            pass
+        assert req.status == 200 and req.sent == file_size
+
+    def get_file_conditional():
+        download_id = random.choice(stored_ids)
+        req = BenchmarkRequest('/downloads/%s' % (download_id,))
+        core.match_request(req)
+        with_context(lambda context: req.headers.update({'if-none-match' :
+          '"%(id)s-%(size)s-%(time)s"' % api.get_download(context,
+          download_id)}))()
+        try:
+            core.process_request(req)
+        except RequestDone:
+            pass
+        assert req.status == 304
+
+    def expand_macro(name, content, cached):
+        def call():
+            if not cached:
+                wiki._invalidate_caches()
+            req = BenchmarkRequest('/wiki/WikiStart')
+            formatter = Formatter(env, Context.from_request(req, 'wiki',
+              'WikiStart'))
+            wiki.expand_macro(formatter, name, content)
+        return call
+
+    def download_links():
+        req = BenchmarkRequest('/wiki/WikiStart')
+        formatter = Formatter(env, Context.from_request(req, 'wiki',
+          'WikiStart'))
+        for file in files:
+            wiki._download_link(formatter, 'download', file, file)
+
+    def timeline_events():
+        req = BenchmarkRequest('/timeline')
+        context = Context.from_request(req)
+        stop = datetime.now(utc)
+        start = datetime.fromtimestamp(to_timestamp(stop) - 30 * 86400, utc)
+        for event in timeline.get_timeline_events(req, start, stop,
+          ['downloads']):
+            for field in ('url', 'title', 'description'):
+                timeline.render_timeline_event(context, field, event)
+
+    return [
+      ('get_downloads', with_context(lambda context: api.get_downloads(context))),
+      ('get_downloads_page', with_context(lambda context:
+        api.get_downloads_page(context, 'time', True))),
+      ('get_featured_downloads', with_context(lambda context:
+        api.get_featured_downloads(context))),
+      ('get_download_by_file', with_context(lambda context:
+        api.get_download_by_file(context, random.choice(files)))),
+      ('get_file', get_file),
+      ('get_file_not_modified', get_file_conditional),
+      ('DownloadsCount_all', expand_macro('DownloadsCount', None, False)),
+      ('DownloadsCount_files', expand_macro('DownloadsCount', ','.join(files[:20]), False)),
+      ('DownloadsCount_files_cached', expand_macro('DownloadsCount', ','.join(files[:20]), True)),
+      ('ListDownloads', expand_macro('ListDownloads', None, False)),
+      ('ListDownloads_cached', expand_macro('ListDownloads', None, True)),
+      ('FeaturedDownloads', expand_macro('FeaturedDownloads', None, False)),
+      ('CustomListDownloads', expand_macro('CustomListDownloads', 'file,size,count', False)),
+      ('download_links', download_links),
+      ('timeline_events', timeline_events)]
+
+def run(sizes, repeats, keep = False):
+    results = []
+    for size in sizes:
+        random.seed(size)
+        path = tempfile.mkdtemp(prefix = 'tracdownloads-benchmark-')
+        try:
+            sys.stderr.write('Creating environment with %s downloads in %s\n'
+              % (size, path))
+            env = create_environment(os.path.join(path, 'env'), size)
+            for name, function in get_benchmarks(env, size):
+                sys.stderr.write('  %s\n' % (name,))
+                result = {'size' : size, 'name' : name, 'repeats' : repeats}
+                try:
+                    result.update(measure(env, function, repeats))
+                except Exception:
+                    # Keep other results if a path can't run here.
+                    result['error'] = traceback.format_exc().splitlines()[-1]
+                results.append(result)
+            env.shutdown()
+        finally:
+            if not keep:
+                shutil.rmtree(path, True)
+    return results
+
+def main():
+    parser = OptionParser(usage = 'python benchmarks/hotpaths.py [options]')
+    parser.add_option('--sizes', default = '100,1000,10000',
+      help = 'comma separated numbers of downloads [default: %default]')
+    parser.add_option('--repeats', type = 'int', default = 50,
+      help = 'number of calls of each hot path [default: %default]')
+    parser.add_option('--output', help = 'write JSON results to file'
+      ' instead of standard output')
+    parser.add_option('--keep', action = 'store_true', default = False,
+      help = 'keep created environments')
+    options, arguments = parser.parse_args()
+
+    report = {'timestamp' : datetime.now(utc).isoformat(),
+      'python' : sys.version.split()[0], 'trac' : trac.__version__,
+      'multiproject_stub' : multiproject_stub, 'repeats' : options.repeats,
+      'results' : run([int(size) for size in options.sizes.split(',')],
+      options.repeats, options.keep)}
+
+    output = options.output and open(options.output, 'w') or sys.stdout
+    try:
+        json.dump(report, output, indent = 2, sort_keys = True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
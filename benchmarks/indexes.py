@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures cost of download lookups used by DownloadsApi before and after
+indices of database schema version 4 are created. Uses in-memory SQLite
+database with download table of schema version 1 and does not need Trac.
+
+Usage: python benchmarks/indexes.py [number of downloads] [repeats]
+"""
+
+# Standard imports.
+import sys, time, random, sqlite3
+
+# Table as created by tracdownloads.db.db1 on SQLite.
+create_table = """CREATE TABLE download (
+    id integer PRIMARY KEY,
+    file text,
+    description text,
+    size integer,
+    time integer,
+    count integer,
+    author text,
+    tags text,
+    component text,
+    version text,
+    platform integer,
+    type integer,
+    featured tinyint)"""
+
+# Indices as created by tracdownloads.db.db4 on SQLite.
+create_indices = ["CREATE INDEX download_file_idx ON download (file)",
+  "CREATE INDEX download_time_idx ON download (time)",
+  "CREATE INDEX download_featured_idx ON download (featured)"]
+
+# Lookups done by DownloadsApi, each with function returning its arguments.
+queries = [
+  ('get_download_by_file', "SELECT id, file FROM download WHERE file = ?",
+    lambda rows: ('release-%s.zip' % random.randint(1, rows),)),
+  ('get_download_id_from_file', "SELECT id FROM download WHERE file = ?",
+    lambda rows: ('release-%s.zip' % random.randint(1, rows),)),
+  ('get_download_by_time', "SELECT id, file FROM download WHERE time = ?",
+    lambda rows: (1000000 + random.randint(1, rows) * 60,)),
+  ('get_new_downloads', "SELECT id, file FROM download WHERE time BETWEEN ? AND ?",
+    lambda rows: (1000000 + rows * 30, 1000000 + rows * 30 + 86400)),
+  ('get_featured_downloads', "SELECT id, file FROM download WHERE featured = 1", lambda rows: ()),
+]
+
+def populate(cursor, rows):
+    cursor.execute(create_table)
+    cursor.executemany("INSERT INTO download (id, file, description, size,"
+      " time, count, author, platform, type, featured) VALUES (?, ?, ?, ?, ?,"
+      " ?, ?, ?, ?, ?)", ((id, 'release-%s.zip' % id, 'Release %s' % id,
+      random.randint(1, 1 << 28), 1000000 + id * 60, 0, 'admin',
+      random.randint(1, 9), random.randint(1, 5), int(id % 500 == 0))
+      for id in xrange(1, rows + 1)))
+
+def measure(cursor, rows, repeats):
+    results = {}
+    for name, sql, arguments in queries:
+        plan = ' '.join([to_text(row[-1]) for row in cursor.execute(
+          'EXPLAIN QUERY PLAN ' + sql, arguments(rows))])
+        start = time.time()
+        for I in xrange(repeats):
+            cursor.execute(sql, arguments(rows)).fetchall()
+        results[name] = ((time.time() - start) / repeats * 1000.0, plan)
+    return results
+
+def to_text(value):
+    return isinstance(value, basestring) and value or str(value)
+
+def main(rows = 100000, repeats = 200):
+    random.seed(0)
+    cursor = sqlite3.connect(':memory:').cursor()
+    populate(cursor, rows)
+
+    before = measure(cursor, rows, repeats)
+    for statement in create_indices:
+        cursor.execute(statement)
+    after = measure(cursor, rows, repeats)
+
+    print 'downloads: %s, repeats: %s' % (rows, repeats)
+    print '%-28s %12s %12s  %s' % ('lookup', 'before [ms]', 'after [ms]', 'query plan after')
+    for name, sql, arguments in queries:
+        print '%-28s %12.3f %12.3f  %s' % (name, before[name][0], after[name][0],
+          after[name][1])
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -7,11 +7,13 @@ setup(
   name = 'TracDownloads',
   version = '0.3.mppv',
   zip_safe = False,
-  packages = ['tracdownloads', 'tracdownloads.db'],
+  packages = ['tracdownloads', 'tracdownloads.db', 'tracdownloads.tests'],
   package_data = {'tracdownloads' : ['templates/*.html', 'htdocs/css/*.css']},
   entry_points = {'trac.plugins': ['TracDownloads.api = tracdownloads.api',
     'TracDownloads.core = tracdownloads.core',
+    'TracDownloads.counter = tracdownloads.counter',
     'TracDownloads.init = tracdownloads.init',
+    'TracDownloads.storage = tracdownloads.storage',
     'TracDownloads.webadmin = tracdownloads.webadmin',
     'TracDownloads.consoleadmin = tracdownloads.consoleadmin',
     'TracDownloads.wiki = tracdownloads.wiki',
@@ -23,5 +25,6 @@ setup(
   author_email = 'blackhex@post.cz',
   url = 'http://trac-hacks.org/wiki/DownloadsPlugin',
   description = 'Project release downloads plugin for Trac',
-  license = '''GPL'''
+  license = '''GPL''',
+  test_suite = 'tracdownloads.tests.suite'
 )
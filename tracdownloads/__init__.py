@@ -1,6 +1,6 @@
 # -*- coding: utf8 -*-
 
-from tracdownloads import api, consoleadmin, core, init, timeline, webadmin, wiki
+from tracdownloads import api, consoleadmin, core, counter, init, storage, timeline, webadmin, wiki
 try:
     from tracdownloads import tags
 except ImportError as e:
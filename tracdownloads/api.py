@@ -1,23 +1,30 @@
 # -*- coding: utf-8 -*-
 
 # Standard imports.
-import os, shutil, unicodedata
+import os, re, time, errno, unicodedata, base64, tempfile, hashlib
 from datetime import datetime
+from contextlib import contextmanager
 
 # Trac imports
-from trac.core import Component, Interface, ExtensionPoint, TracError
-from trac.config import Option, IntOption, BoolOption, ListOption
+from trac.core import Component, Interface, ExtensionPoint, TracError, implements
+from trac.config import Option, IntOption, BoolOption, ListOption, ExtensionOption
 from trac.resource import Resource
 from trac.mimeview import Mimeview
 from trac.web.chrome import add_stylesheet, add_script
 from trac.util.datefmt import to_timestamp, utc, format_datetime
 from trac.util.text import to_unicode
-from trac.web.api import RequestDone
+from trac.web.api import RequestDone, IRequestFilter
 
 #cqde imports
 from multiproject.core.configuration import conf
 from multiproject.core.db import safe_int
 
+# Local imports.
+from cache import Cache
+from batch import Flusher
+from stats import QueryStats
+from dispatch import DownloadEvent, DownloadDispatcher
+import transfer
 
 class IDownloadChangeListener(Interface):
     """Extension point interface for components that require notification
@@ -37,26 +44,104 @@ class IDownloadChangeListener(Interface):
         a dictionary with values of fields of just deleted download."""
 
 class IDownloadListener(Interface):
+    """Extension point interface for components that require notification
+    when a file is downloaded. Listener can define `downloaded_batch(events)`
+    method which gets list of `DownloadEvent` objects with `download`,
+    `authname` and `time` attributes from background thread instead of
+    `downloaded` call for each event, unless [downloads]
+    async_download_events option is disabled."""
+
     def downloaded(context, download): #@NoSelf
-        """Called when a file is downloaded
+        """Called when a file is downloaded, in the thread of the request.
         """
 
+class IDownloadStorage(Interface):
+    """Extension point interface for components that store files of
+    downloads."""
+
+    def put(download, temp_path, old_download = None): #@NoSelf
+        """Stores file at `temp_path` as file of `download`. File may be moved
+        from `temp_path`. If `old_download` is given, its file is replaced."""
+
+    def open(download): #@NoSelf
+        """Returns file object opened for binary reading of file of
+        `download`."""
+
+    def stat(download): #@NoSelf
+        """Returns `os.stat()` like result with at least `st_size` and
+        `st_mtime` of file of `download`."""
+
+    def delete(download): #@NoSelf
+        """Removes file of `download`."""
+
+    def get_offload_header(download, mode, prefix): #@NoSelf
+        """Returns name and value of header which lets front-end server
+        transfer file of `download` in offload `mode` or None if file can't
+        be offloaded. `prefix` is internal URL of downloads directory."""
+
 class HelperContext():
     """ Simple database context holder
     """
     def __init__(self, cursor):
         self.cursor = cursor
 
+@contextmanager
+def database_context(env, context, commit = False):
+    """
+    Provides <context> with database connection and cursor within with
+    statement. Connection already held by <context> is reused, connections
+    taken from Trac's pool are shared by the whole request thread anyway.
+    Cursor is always closed on exit. Changes are committed if <commit> is
+    set and the block succeeds, otherwise they are rolled back. Functions
+    appended to commit_callbacks list of <context> are called after the
+    outermost committing block commits.
+    """
+    old_db = getattr(context, 'db', None)
+    old_cursor = getattr(context, 'cursor', None)
+    old_callbacks = getattr(context, 'commit_callbacks', None)
+    context.db = old_db or env.get_db_cnx()
+    context.cursor = context.db.cursor()
+    if commit and old_callbacks is None:
+        context.commit_callbacks = []
+    try:
+        try:
+            yield context.db
+        except:
+            if commit:
+                context.db.rollback()
+            raise
+        if commit:
+            context.db.commit()
+            if old_callbacks is None:
+                for callback in context.commit_callbacks:
+                    callback()
+    finally:
+        context.cursor.close()
+        context.db = old_db
+        context.cursor = old_cursor
+        context.commit_callbacks = old_callbacks
+
 class DownloadsApi(Component):
+    implements(IRequestFilter, IDownloadChangeListener)
 
     # Download change listeners.
     change_listeners = ExtensionPoint(IDownloadChangeListener)
     download_listeners = ExtensionPoint(IDownloadListener)
 
+    download_columns = ('id', 'file', 'description', 'size', 'time', 'count', 'author',
+                        'tags', 'component', 'version', 'platform', 'type', 'featured',
+                        'mimetype', 'charset', 'sha256', 'md5')
+    download_integer_columns = ('id', 'size', 'time', 'count', 'platform', 'type', 'featured')
     download_sort_options  = ('id', 'file','description', 'size', 'time', 'count', 'author', 'tags', 'component', 'version', 'platform', 'type')
     platform_sort_options = ('id', 'name', 'description')
     type_sort_options = ('id', 'name', 'description')
 
+    # Cached metadata tables and their columns.
+    metadata_tables = {'platforms' : ('platform', ('id', 'name', 'description')),
+                       'types' : ('download_type', ('id', 'name', 'description')),
+                       'components' : ('component', ('name', 'description')),
+                       'versions' : ('version', ('name', 'description'))}
+
     # Configuration options.
     title = Option('downloads', 'title', 'Downloads', doc = 'Main navigation bar button title.')
     ext = ListOption('downloads', 'ext', 'zip,gz,bz2,rar',
@@ -65,7 +150,8 @@ class DownloadsApi(Component):
                           'Maximum allowed file size (in bytes) for downloads. Default is 256 MB.')
     visible_fields = ListOption('downloads', 'visible_fields',
                                  'id,file,description,size,time,count,author,tags,component,version,platform,type',
-                                 doc = 'List of downloads table fields that should be visible to users on Downloads section.')
+                                 doc = 'List of downloads table fields that should be visible to users on Downloads section.'
+                                 ' Checksum fields sha256 and md5 can be added too.')
     download_sort = Option('downloads', 'download_sort', 'time',
                             'Column by which downloads list will be sorted. Possible values are: %s. Default value is: time.' % ','.join(download_sort_options))
     download_sort_direction = Option('downloads', 'download_sort_direction', 'desc',
@@ -78,11 +164,158 @@ class DownloadsApi(Component):
                         ' list will be sorted. Possible values are: %s. Default value is: name.' % ','.join(type_sort_options))
     type_sort_direction = Option('downloads', 'type_sort_direction', 'asc',
                                   'Direction of types list sorting. Possible values are: asc, desc. Default value is: asc.')
+    page_size = IntOption('downloads', 'page_size', 100,
+                           'Number of downloads displayed on one page of downloads list. Zero disables paging.')
+    metadata_cache_ttl = IntOption('downloads', 'metadata_cache_ttl', 300,
+                                    'Number of seconds platforms, types, components and versions are cached in memory. Zero means no expiration.')
+    summary_cache_ttl = IntOption('downloads', 'summary_cache_ttl', 300,
+                                   'Number of seconds summary of featured downloads shown on project front page is'
+                                   ' cached in memory. Zero means no expiration.')
+    offload = Option('downloads', 'offload', '',
+                      'Let front-end server send downloaded files. Possible values are: x-sendfile (Apache'
+                      ' mod_xsendfile, lighttpd), x-accel-redirect (nginx). Files are sent by Trac if empty.')
+    offload_prefix = Option('downloads', 'offload_prefix', '/protected-downloads',
+                             'Internal location of front-end server mapped to downloads directory. Used by'
+                             ' x-accel-redirect offload mode.')
+    slow_query_threshold = IntOption('downloads', 'slow_query_threshold', 500,
+                                      'Number of milliseconds after which database query is logged as slow. Zero'
+                                      ' disables the slow query log.')
+    query_stats_interval = IntOption('downloads', 'query_stats_interval', 60,
+                                      'Number of seconds after which query statistics are saved to log directory of'
+                                      ' the environment for trac-admin download stats command. Zero disables saving.')
     unique_filename = BoolOption('downloads', 'unique_filename', False,
                                   doc = 'If enabled checks if uploaded file has unique name.')
+    storage = ExtensionOption('downloads', 'storage', IDownloadStorage, 'LocalDownloadsStorage',
+                               'Name of component which stores files of downloads. Possible values are:'
+                               ' LocalDownloadsStorage (directory per download), ShardedDownloadsStorage'
+                               ' (directories spread by hash of download ID).')
+    async_download_events = BoolOption('downloads', 'async_download_events', True,
+                                        doc = 'If enabled download listeners with batch support like download'
+                                        ' counter are notified from background thread, so file transfer doesn\'t'
+                                        ' wait for them. Events queued for download_events_interval seconds and'
+                                        ' counts not written by the counter yet are lost if server process'
+                                        ' doesn\'t exit cleanly.')
+    download_events_interval = IntOption('downloads', 'download_events_interval', 1,
+                                          'Number of seconds after which download events are delivered to'
+                                          ' listeners from background thread.')
+    download_events_size = IntOption('downloads', 'download_events_size', 100,
+                                      'Number of queued download events which causes their immediate delivery'
+                                      ' to listeners.')
 
     def __init__(self):
         self.path = conf.getEnvironmentDownloadsPath(self.env)
+        self.metadata_cache = Cache()
+        self.metadata_generation = 0
+        self.summary_cache = Cache(1)
+        self.query_stats = QueryStats()
+        self.stats_flusher = Flusher('DownloadsQueryStats', self.save_query_stats,
+          self.log, self.query_stats_interval)
+        self.download_dispatcher = DownloadDispatcher(lambda:
+          self.download_listeners, self.log, self.download_events_interval,
+          self.download_events_size)
+
+    # IDownloadChangeListener methods.
+
+    def download_created(self, context, download):
+        self.summary_cache.invalidate()
+
+    def download_changed(self, context, download, old_download):
+        self.summary_cache.invalidate()
+
+    def download_deleted(self, context, download):
+        self.summary_cache.invalidate()
+
+    # IRequestFilter methods.
+
+    def pre_process_request(self, req, handler):
+        # Count queries of the request.
+        self.query_stats.start_request(req.path_info)
+
+        # Versions and components are managed by Trac itself. Their admin
+        # panels redirect to themselves after POST, so the cache is
+        # invalidated when the panel is displayed after the change is
+        # committed. Invalidation before POST is processed would let
+        # concurrent requests cache old items again. Other processes and
+        # changes done by trac-admin reload them when metadata_cache_ttl
+        # expires.
+        if req.method != 'POST' and re.match(
+          r'''^/admin/ticket/(components|versions)(/|$)''', req.path_info):
+            self.invalidate_metadata()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        request = self.query_stats.finish_request()
+        if request and request['queries']:
+            self.log.debug('Downloads queries of %s: %s queries, %.1f ms, %s rows',
+              req.path_info, request['queries'], request['time'] * 1000.0,
+              request['rows'])
+            if self.query_stats_interval > 0:
+                self.stats_flusher.start()
+        return template, data, content_type
+
+    # Query instrumentation functions.
+
+    def _execute(self, context, sql, values = ()):
+        """
+        Executes <sql> query with <values> on cursor of <context>. Returns
+        list of result rows of SELECT query. Query is counted to statistics of
+        current request and logged if it's slow.
+        """
+        self.log.debug("%s, %s", sql, values)
+        start = time.time()
+        context.cursor.execute(sql, values)
+        rows = []
+        if sql.lstrip().upper().startswith('SELECT'):
+            rows = context.cursor.fetchall()
+        self._record_query(sql, values, time.time() - start, len(rows))
+        return rows
+
+    def _iterate(self, context, sql, values = (), size = 100):
+        """
+        Executes SELECT <sql> query with <values> on cursor of <context> and
+        yields result rows fetched in batches of <size> rows. Query is counted
+        to statistics when all rows are read. Rows are streamed from database
+        only on SQLite, default cursors of MySQL and PostgreSQL backends read
+        whole result to memory of client on execution.
+        """
+        self.log.debug("%s, %s", sql, values)
+        start = time.time()
+        context.cursor.execute(sql, values)
+        duration = time.time() - start
+        count = 0
+        while True:
+            start = time.time()
+            rows = context.cursor.fetchmany(size)
+            duration += time.time() - start
+            if not rows:
+                break
+            count += len(rows)
+            for row in rows:
+                yield row
+        self._record_query(sql, values, duration, count)
+
+    def _record_query(self, sql, values, duration, rows):
+        # Counts query to statistics and logs it if it's slow.
+        slow = self.slow_query_threshold > 0 and duration * 1000.0 >= \
+          self.slow_query_threshold
+        if slow:
+            self.log.warning('Slow downloads query (%.1f ms, %s rows): %s, %s',
+              duration * 1000.0, rows, sql, values)
+        self.query_stats.record(sql, duration, rows, slow)
+
+    def get_stats_directory(self):
+        """
+        Returns directory where query statistics of server processes are
+        saved.
+        """
+        return os.path.join(self.env.path, 'log')
+
+    def save_query_stats(self):
+        """
+        Saves query statistics of this process for trac-admin download stats
+        command.
+        """
+        self.query_stats.save(self.get_stats_directory())
 
     # Get list functions.
     def _get_items(self, context, table, columns, where = '', values = (), order_by = '', desc = False):
@@ -96,20 +329,74 @@ class DownloadsApi(Component):
         sql = 'SELECT ' + ', '.join(columns) + ' FROM ' + table + (where
           and (' WHERE ' + where) or '') + (order_by and (' ORDER BY ' +
           order_by + (' ASC', ' DESC')[bool(desc)]) or '')
-        self.log.debug("%s, %s", sql, values)
         items = []
         try:
-            context.cursor.execute(sql, values)
-            for row in context.cursor:
+            for row in self._execute(context, sql, values):
                 row = dict(zip(columns, row))
                 items.append(row)
         except:
             self.log.exception("Cannot get items. query= %s", sql)
         return items
 
+    # Cached metadata functions.
+    def _get_metadata(self, context, name):
+        # Platforms, types, components and versions are read once and kept in
+        # memory until they are changed or their lifetime expires. Failed read
+        # is not cached, so next call tries again.
+        table, columns = self.metadata_tables[name]
+        sql = 'SELECT ' + ', '.join(columns) + ' FROM ' + table
+        def retrieve():
+            return [dict(zip(columns, row)) for row in self._execute(context,
+              sql)]
+        try:
+            return self.metadata_cache.get(name, retrieve,
+              self.metadata_cache_ttl)
+        except:
+            self.log.exception("Cannot get items. query= %s", sql)
+            return []
+
+    def _get_sorted_metadata(self, context, name, order_by, desc):
+        # IMPORTANT: Check parameter validity to prevent possible vulnerability
+        columns = self.metadata_tables[name][1]
+        if order_by not in columns:
+            self.log.warning('Invalid sort option: %s' % order_by)
+            return []
+
+        def sort_key(item):
+            value = item[order_by]
+            if isinstance(value, basestring):
+                return value.lower()
+            return value
+
+        # Return copies so callers can't modify cached items.
+        items = [dict(item) for item in self._get_metadata(context, name)]
+        return sorted(items, key = sort_key, reverse = bool(desc))
+
+    def invalidate_metadata(self, name = None, context = None):
+        """
+        Drops cached platforms, types, components or versions. All of them are
+        dropped if no <name> is given. If <context> is in transaction opened
+        by database_context(), they are dropped once more after the
+        transaction is committed, so concurrent requests can't cache old
+        items for whole metadata_cache_ttl.
+        """
+        callbacks = getattr(context, 'commit_callbacks', None)
+        if callbacks is not None:
+            callbacks.append(lambda: self._invalidate_metadata(name))
+        self._invalidate_metadata(name)
+
+    def _invalidate_metadata(self, name):
+        self.log.debug('Invalidating downloads metadata cache: %s' % (name,))
+        self.metadata_cache.invalidate(name)
+        self.metadata_generation += 1
+
+        # Summary contains platform names.
+        if name in (None, 'platforms'):
+            self.summary_cache.invalidate()
+
     def get_versions(self, context, order_by = 'name', desc = False):
-        # Get versions from table.
-        versions = self._get_items(context, 'version', ('name', 'description'), order_by = order_by, desc = desc)
+        # Get versions from cache.
+        versions = self._get_sorted_metadata(context, 'versions', order_by, desc)
         # Add IDs to versions according to selected sorting.
         id = 0
         for version in versions:
@@ -118,8 +405,8 @@ class DownloadsApi(Component):
         return versions
 
     def get_components(self, context, order_by = 'name', desc = False):
-        # Get components from table.
-        components = self._get_items(context, 'component', ('name', 'description'), order_by = order_by, desc = desc)
+        # Get components from cache.
+        components = self._get_sorted_metadata(context, 'components', order_by, desc)
         # Add IDs to versions according to selected sorting.
         id = 0
         for component in components:
@@ -127,147 +414,302 @@ class DownloadsApi(Component):
             component['id'] = id
         return components
 
-    def get_downloads(self, context, order_by = 'id', desc = False):
-        # Get downloads from table.
-        downloads = self._get_items(context, 'download',
-                                    ('id', 'file', 'description', 'size', 'time', 'count', 'author',
-                                     'tags', 'component', 'version', 'platform', 'type', 'featured'),
-                                     order_by = order_by, desc = desc)
-        # Replace field IDs with apropriate objects.
-        for download in downloads:
-            download['platform'] = self.get_platform(context, download['platform'])
-            download['type'] = self.get_type(context, download['type'])
+    def _get_downloads(self, context, where = '', values = (), order_by = 'id', desc = False, limit = None):
+        # IMPORTANT: Check parameter validity to prevent possible vulnerability
+        if order_by and order_by not in self.download_sort_options:
+            self.log.warning('Invalid sort option: %s' % order_by)
+            return []
+
+        sql = self._get_downloads_sql(where, order_by, desc, limit)
+        downloads = []
+        try:
+            for row in self._execute(context, sql, values):
+                downloads.append(self._download_from_row(row))
+        except:
+            self.log.exception("Cannot get downloads. query= %s", sql)
         return downloads
 
+    def iter_downloads(self, context, where = '', values = (), order_by = 'id', desc = False):
+        """
+        Yields downloads matching <where> condition with <values> one by one
+        as they are read from database, so they don't have to fit in memory,
+        see _iterate() for limits. Columns of condition are prefixed by d for
+        download, p for platform and t for type table.
+        """
+        # IMPORTANT: Check parameter validity to prevent possible vulnerability
+        if order_by and order_by not in self.download_sort_options:
+            self.log.warning('Invalid sort option: %s' % order_by)
+            return
+
+        for row in self._iterate(context, self._get_downloads_sql(where,
+          order_by, desc), values):
+            yield self._download_from_row(row)
+
+    def _get_downloads_sql(self, where = '', order_by = 'id', desc = False, limit = None):
+        # Resolve platform and type of each download in the same query. Rows
+        # with equal sort values are ordered by ID so the order is stable.
+        columns = ['d.' + column for column in self.download_columns] + \
+          ['p.id', 'p.name', 'p.description', 't.id', 't.name', 't.description']
+        direction = (' ASC', ' DESC')[bool(desc)]
+        sql = 'SELECT ' + ', '.join(columns) + ' FROM download d' \
+          ' LEFT JOIN platform p ON p.id = d.platform' \
+          ' LEFT JOIN download_type t ON t.id = d.type' + (where and
+          (' WHERE ' + where) or '') + (order_by and (' ORDER BY ' +
+          self._get_sort_expression(order_by) + direction + (order_by != 'id'
+          and (', d.id' + direction) or '')) or '') + (limit and
+          (' LIMIT %d' % (limit,)) or '')
+        return sql
+
+    def _get_sort_expression(self, order_by):
+        # NULL values are sorted as empty values to get the same order on all
+        # database backends and to be able to compare them in page keys.
+        if order_by == 'id':
+            return 'd.id'
+        elif order_by == 'platform':
+            return 'COALESCE(p.id, 0)'
+        elif order_by == 'type':
+            return 'COALESCE(t.id, 0)'
+        elif order_by in self.download_integer_columns:
+            return 'COALESCE(d.%s, 0)' % (order_by,)
+        return "COALESCE(d.%s, '')" % (order_by,)
+
+    def _get_page_key(self, download, order_by):
+        # Page key consists of sort column value and download ID. It's encoded
+        # to be safely usable in URLs.
+        value = download[order_by]
+        if isinstance(value, dict):
+            value = value['id']
+        if value is None:
+            value = ''
+            if order_by in self.download_integer_columns:
+                value = 0
+        key = u'%s:%s' % (download['id'], value)
+        return base64.urlsafe_b64encode(key.encode('utf-8')).rstrip('=')
+
+    def _parse_page_key(self, key, order_by):
+        try:
+            key = base64.urlsafe_b64decode(str(key) + '=' * (-len(key) % 4))
+            id, value = to_unicode(key, 'utf-8').split(':', 1)
+            if order_by in self.download_integer_columns:
+                value = int(value)
+            return int(id), value
+        except (TypeError, ValueError, UnicodeError):
+            self.log.debug('Invalid page key: %s' % (key,))
+            return None
+
+    def get_page_download_id(self, context, key, order_by):
+        """
+        Returns ID of download which page <key> of list sorted by <order_by>
+        column refers to, or None if the key is invalid or doesn't match
+        current values of the download.
+        """
+        parsed_key = key and self._parse_page_key(key, order_by)
+        if not parsed_key:
+            return None
+        download = self.get_download(context, parsed_key[0])
+        if not download or self._get_page_key(download, order_by) != key:
+            return None
+        return download['id']
+
+    def get_downloads_page(self, context, order_by = 'id', desc = False, after = None,
+      before = None, featured = False, limit = None):
+        """
+        Returns one page of downloads sorted by <order_by> column together with
+        keys of previous and next pages. Page starts right after download
+        with key <after> or ends right before download with key <before>. If
+        none of them is specified, first page is returned.
+        """
+        if limit is None:
+            limit = self.page_size
+
+        # Paging disabled.
+        if limit <= 0:
+            if featured:
+                return self.get_featured_downloads(context, order_by, desc), None, None
+            return self.get_downloads(context, order_by, desc), None, None
+
+        if order_by not in self.download_sort_options:
+            self.log.warning('Invalid sort option: %s' % order_by)
+            return [], None, None
+
+        where = featured and ['d.featured = 1'] or []
+        values = []
+
+        # Restrict rows to the ones following or preceding the page key.
+        backward = False
+        key = None
+        if before:
+            key = self._parse_page_key(before, order_by)
+            backward = key is not None
+        if key is None and after:
+            key = self._parse_page_key(after, order_by)
+        if key is not None:
+            id, value = key
+            operator = ('>', '<')[bool(desc) != backward]
+            if order_by == 'id':
+                where.append('d.id %s %%s' % (operator,))
+                values.append(id)
+            else:
+                expression = self._get_sort_expression(order_by)
+                where.append('(%s %s %%s OR (%s = %%s AND d.id %s %%s))' % (
+                  expression, operator, expression, operator))
+                values.extend([value, value, id])
+
+        # Get one download more to know if there is another page.
+        downloads = self._get_downloads(context, ' AND '.join(where),
+          tuple(values), order_by, bool(desc) != backward, limit + 1)
+        has_more = len(downloads) > limit
+        downloads = downloads[:limit]
+        if backward:
+            downloads.reverse()
+
+        # Determine keys of neighbour pages.
+        previous_key = None
+        next_key = None
+        if downloads:
+            if (backward and has_more) or (not backward and key is not None):
+                previous_key = self._get_page_key(downloads[0], order_by)
+            if backward or has_more:
+                next_key = self._get_page_key(downloads[-1], order_by)
+        return downloads, previous_key, next_key
+
+    def _download_from_row(self, row):
+        # Split joined row to download, platform and type parts.
+        count = len(self.download_columns)
+        download = dict(zip(self.download_columns, row[:count]))
+        platform = dict(zip(('id', 'name', 'description'), row[count:count + 3]))
+        type = dict(zip(('id', 'name', 'description'), row[count + 3:count + 6]))
+
+        # Missing platform or type is represented the same way as in
+        # get_platform() and get_type().
+        if platform['id'] is None:
+            platform = {'id' : 0, 'name' : '', 'description' : ''}
+        if type['id'] is None:
+            type = {'id' : 0, 'name' : '', 'description' : ''}
+        download['platform'] = platform
+        download['type'] = type
+        return download
+
+    def get_downloads(self, context, order_by = 'id', desc = False):
+        return self._get_downloads(context, order_by = order_by, desc = desc)
+
     def get_featured_downloads(self, context, order_by = 'id', desc = False):
-        # Get downloads from table.
-        downloads = self._get_items(context, 'download',
-                                    ('id', 'file', 'description', 'size', 'time', 'count', 'author',
-                                     'tags', 'component', 'version', 'platform', 'type'),
-                                     "featured = 1",
-                                     order_by = order_by, desc = desc)
-        # Replace field IDs with apropriate objects.
-        for download in downloads:
-            download['platform'] = self.get_platform(context, download['platform'])
-            download['type'] = self.get_type(context, download['type'])
-        return downloads
+        return self._get_downloads(context, 'd.featured = 1',
+          order_by = order_by, desc = desc)
 
-    def get_new_downloads(self, context, start, stop, order_by = 'time', desc = False):
-        return self._get_items(context, 'download',
-                               ('id', 'file', 'description', 'size', 'time', 'count', 'author',
-                                'tags', 'component', 'version', 'platform', 'type', 'featured'),
-                                'time BETWEEN %s AND %s', (start, stop), order_by = order_by, desc = desc)
+    def get_new_downloads(self, context, start, stop, order_by = 'time', desc = False, columns = None):
+        return self._get_items(context, 'download', columns or self.download_columns,
+                               'time BETWEEN %s AND %s', (start, stop), order_by = order_by, desc = desc)
 
     def get_platforms(self, context, order_by = 'id', desc = False):
-        return self._get_items(context, 'platform', ('id', 'name',
-          'description'), order_by = order_by, desc = desc)
+        return self._get_sorted_metadata(context, 'platforms', order_by, desc)
 
     def get_types(self, context, order_by = 'id', desc = False):
-        return self._get_items(context, 'download_type', ('id', 'name',
-          'description'), order_by = order_by, desc = desc)
+        return self._get_sorted_metadata(context, 'types', order_by, desc)
 
     # Get one item functions.
     def _get_item(self, context, table, columns, where = '', values = ()):
         sql = 'SELECT ' + ', '.join(columns) + ' FROM ' + table + (where and (' WHERE ' + where) or '')
         self.log.debug("%s, %s", sql, values)
         try:
+            start = time.time()
             context.cursor.execute(sql, values)
-            for row in context.cursor:
-                row = dict(zip(columns, row))
-                return row
+            row = context.cursor.fetchone()
+            self._record_query(sql, values, time.time() - start, int(row is not None))
+            if row:
+                return dict(zip(columns, row))
         except:
             self.log.exception("Cannot get item. query = %s, values = %s", sql, values)
         return None
 
     def get_download(self, context, id):
-        return self._get_item(context, 'download',
-                              ('id', 'file', 'description', 'size', 'time', 'count', 'author',
-                               'tags', 'component', 'version', 'platform', 'type', 'featured'),
-                               'id = %s', (id,))
+        return self._get_item(context, 'download', self.download_columns,
+                              'id = %s', (id,))
 
     def get_download_by_time(self, context, time):
-        return self._get_item(context, 'download',
-                              ('id', 'file', 'description', 'size', 'time', 'count', 'author',
-                               'tags', 'component', 'version', 'platform', 'type', 'featured'),
-                               'time = %s', (time,))
+        return self._get_item(context, 'download', self.download_columns,
+                              'time = %s', (time,))
 
     def get_download_by_file(self, context, file):
-        return self._get_item(context, 'download',
-                              ('id', 'file', 'description', 'size', 'time', 'count', 'author',
-                               'tags', 'component', 'version', 'platform', 'type', 'featured'),
-                               'file = %s', (file,))
+        return self._get_item(context, 'download', self.download_columns,
+                              'file = %s', (file,))
+
+    def _get_metadata_item(self, context, name, column, value):
+        for item in self._get_metadata(context, name):
+            if item[column] == value:
+                return dict(item)
+        return {'id' : 0, 'name' : '', 'description' : ''}
 
     def get_platform(self, context, id):
-        platform = self._get_item(context, 'platform', ('id', 'name', 'description'), 'id = %s', (id,))
-        if not platform:
-            platform = {'id' : 0, 'name' : '', 'description' : ''}
-        return platform
+        return self._get_metadata_item(context, 'platforms', 'id', safe_int(id))
 
     def get_platform_by_name(self, context, name):
-        platform = self._get_item(context, 'platform', ('id', 'name', 'description'), 'name = %s', (name,))
-        if not platform:
-            platform = {'id' : 0, 'name' : '', 'description' : ''}
-        return platform
+        return self._get_metadata_item(context, 'platforms', 'name', name)
 
     def get_type(self, context, id):
-        type = self._get_item(context, 'download_type', ('id', 'name', 'description'), 'id = %s', (id,))
-        if not type:
-            type = {'id' : 0, 'name' : '', 'description' : ''}
-        return type
+        return self._get_metadata_item(context, 'types', 'id', safe_int(id))
 
     def get_type_by_name(self, context, name):
-        type = self._get_item(context, 'download_type', ('id', 'name', 'description'), 'name = %s', (name,))
-        if not type:
-            type = {'id' : 0, 'name' : '', 'description' : ''}
-        return type
+        return self._get_metadata_item(context, 'types', 'name', name)
 
     def get_description(self, context):
         sql = "SELECT value FROM system WHERE name = 'downloads_description'"
-        self.log.debug(sql)
-        context.cursor.execute(sql)
-        for row in context.cursor:
+        for row in self._execute(context, sql):
             return row[0]
 
     def get_summary_items(self):
-        featured = []
+        """
+        Returns featured downloads with their platform names and URLs for
+        project front page. Summary is cached until featured downloads,
+        downloads or platforms change or its lifetime expires. Summary which
+        couldn't be read is not cached.
+        """
+        try:
+            items = self.summary_cache.get('summary', self._get_summary_items,
+              self.summary_cache_ttl)
+        except:
+            self.log.exception("Cannot get featured downloads summary.")
+            return []
 
-        # Get database access.
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
+        # Return copies so callers can't modify cached items.
+        return [dict(item) for item in items]
+
+    def _get_summary_items(self):
+        featured = []
 
         # Create context
-        context = HelperContext(cursor)
+        context = HelperContext(None)
+
+        with database_context(self.env, context):
+            # Get downloads with their platforms from one query. Errors are
+            # propagated, so failed read isn't cached.
+            downloads = [self._download_from_row(row) for row in
+              self._execute(context, self._get_downloads_sql('d.featured = 1'))]
 
-        # Get downloads from table.
-        downloads = self._get_items(context, 'download', ('id', 'file', 'platform'), "featured = 1",
-                                     order_by = 'id', desc = False)
-        # Replace field IDs with apropriate objects and add downloads.
+        # Prepare titles and URLs of downloads.
         for download in downloads:
-            platform = self.get_platform(context, download['platform'])
             path = conf.getEnvironmentDownloadsUrl(self.env, to_unicode(download['id']))
             self.log.debug('Download url is %s' % (path,))
             if len(download['file']) > 28:
                 title = download['file'][0:28] + "..."
             else:
                 title = download['file']
-            featured.append({ 'platform': platform['name'], 'url': path, 'title': title, 'origtitle': download['file']})
-        cursor.close()
-        db.close()
+            featured.append({ 'platform': download['platform']['name'], 'url': path, 'title': title, 'origtitle': download['file']})
         return featured
 
     def clean_featured(self, context):
         sql = "UPDATE download SET featured = 0 WHERE featured = 1"
-        self.log.debug(sql)
-        context.cursor.execute(sql)
+        self._execute(context, sql)
+        self.summary_cache.invalidate()
 
     def edit_featured(self, context, download_ids):
         try:
             sql = "UPDATE download SET featured = 1 WHERE id IN (" + \
              ', '.join([to_unicode(safe_int(download_id)) for download_id in download_ids]) + ')'
-            self.log.debug(sql)
-            context.cursor.execute(sql)
+            self._execute(context, sql)
         except:
             self.log.exception("Downloads featured operation failed, query was %s ", sql)
+        self.summary_cache.invalidate()
 
     # Add item functions.
     def _add_item(self, context, table, item):
@@ -275,20 +717,33 @@ class DownloadsApi(Component):
         values = item.values()
         sql = "INSERT INTO %s (" % (table,) + ", ".join(fields) + ") VALUES (" \
           + ", ".join(["%s" for I in xrange(len(fields))]) + ")"
-        self.log.debug("%s, %s" % (sql, tuple(values)))
         try:
-            context.cursor.execute(sql, tuple(values))
+            self._execute(context, sql, tuple(values))
+            return True
         except:
             self.log.exception("Downloads add operation failed, query was %s, values %s", sql, values)
+            return False
 
     def add_download(self, context, download):
-        self._add_item(context, 'download', download)
+        """
+        Inserts <download> to database and returns its new ID or None if
+        insert failed.
+        """
+        if not self._add_item(context, 'download', download):
+            return None
+
+        # Last inserted ID is tracked per connection by database backend, so
+        # it's not affected by concurrent inserts.
+        db = getattr(context, 'db', None) or self.env.get_db_cnx()
+        return db.get_last_id(context.cursor, 'download')
 
     def add_platform(self, context, platform):
         self._add_item(context, 'platform', platform)
+        self.invalidate_metadata('platforms', context)
 
     def add_type(self, context, type):
         self._add_item(context, 'download_type', type)
+        self.invalidate_metadata('types', context)
 
     # Edit item functions.
 
@@ -297,33 +752,31 @@ class DownloadsApi(Component):
         values = item.values()
         sql = "UPDATE %s SET " % (table,) + ", ".join([("%s = %%s" % (field))
           for field in fields]) + " WHERE id = %s"
-        self.log.debug("%s, %s", sql, tuple(values + [id]))
-        context.cursor.execute(sql, tuple(values + [id]))
+        self._execute(context, sql, tuple(values + [id]))
 
     def edit_download(self, context, id, download):
         self._edit_item(context, 'download', id, download)
 
     def edit_platform(self, context, id, platform):
         self._edit_item(context, 'platform', id, platform)
+        self.invalidate_metadata('platforms', context)
 
     def edit_type(self, context, id, type):
         self._edit_item(context, 'download_type', id, type)
+        self.invalidate_metadata('types', context)
 
     def edit_description(self, context, description):
         sql = "UPDATE system SET value = %s WHERE name = 'downloads_description'"
-        self.log.debug("%s, %s", sql, description)
-        context.cursor.execute(sql, (description,))
+        self._execute(context, sql, (description,))
 
     # Delete item functions.
     def _delete_item(self, context, table, id):
         sql = "DELETE FROM " + table + " WHERE id = %s"
-        self.log.debug("%s, %s", sql, id)
-        context.cursor.execute(sql, (id,))
+        self._execute(context, sql, (id,))
 
     def _delete_item_ref(self, context, table, column, id):
         sql = "UPDATE " + table + " SET " + column + " = NULL WHERE " + column + " = %s"
-        self.log.debug("%s, %s", sql, id)
-        context.cursor.execute(sql, (id,))
+        self._execute(context, sql, (id,))
 
     def delete_download(self, context, id):
         self._delete_item(context, 'download', id)
@@ -331,19 +784,19 @@ class DownloadsApi(Component):
     def delete_platform(self, context, id):
         self._delete_item(context, 'platform', id)
         self._delete_item_ref(context, 'download', 'platform', id)
+        self.invalidate_metadata('platforms', context)
 
     def delete_type(self, context, id):
         self._delete_item(context, 'download_type', id)
         self._delete_item_ref(context, 'download', 'type', id)
+        self.invalidate_metadata('types', context)
 
     # Misc database access functions.
 
     def _get_attribute(self, context, table, column, where = '', values = ()):
         sql = 'SELECT ' + column + ' FROM ' + table + (where and (' WHERE ' +
           where) or '')
-        self.log.debug("%s, %s", sql, values)
-        context.cursor.execute(sql, values)
-        for row in context.cursor:
+        for row in self._execute(context, sql, values):
             return row[0]
         return None
 
@@ -355,27 +808,61 @@ class DownloadsApi(Component):
         sql = 'SELECT SUM(count) FROM download' + (download_ids and
           (' WHERE id in (' + ', '.join([to_unicode(safe_int(download_id)) for download_id
           in download_ids]) + ')') or '')
-        self.log.debug(sql)
-        context.cursor.execute(sql)
-        for row in context.cursor:
+        for row in self._execute(context, sql):
             return row[0]
         return None
 
+    def get_download_files(self, context):
+        """
+        Returns list of dictionaries with ID, file name and size of all
+        downloads ordered by ID.
+        """
+        sql = 'SELECT id, file, size FROM download ORDER BY id'
+        return [{'id' : row[0], 'file' : row[1], 'size' : row[2]} for row in
+          self._execute(context, sql)]
+
+    def get_download_counts(self, context, ids = (), files = ()):
+        """
+        Returns list of tuples with ID, file name and download count of
+        downloads with <ids> or with <files> names ordered by ID. All of them
+        are read by one query.
+        """
+        conditions = []
+        values = []
+        if ids:
+            conditions.append('id IN (' + ', '.join(['%s'] * len(ids)) + ')')
+            values += [safe_int(download_id) for download_id in ids]
+        if files:
+            conditions.append('file IN (' + ', '.join(['%s'] * len(files)) + ')')
+            values += list(files)
+        if not conditions:
+            return []
+        sql = 'SELECT id, file, count FROM download WHERE ' + \
+          ' OR '.join(conditions) + ' ORDER BY id'
+        return [(row[0], row[1], row[2] or 0) for row in
+          self._execute(context, sql, tuple(values))]
+
+    def get_total_count(self, context):
+        """
+        Returns sum of download counts of all downloads.
+        """
+        sql = 'SELECT SUM(count) FROM download'
+        rows = self._execute(context, sql)
+        return rows and rows[0][0] or 0
+
     # Proces request functions.
     def process_downloads(self, context):
         # Clear data for next request.
         req_data = {}
 
-        # Get database access.
-        db = self.env.get_db_cnx()
-        context.cursor = db.cursor()
+        # Get database access, changes are committed if all actions succeed.
+        with database_context(self.env, context, commit = True):
+            # Get request mode
+            modes = self._get_modes(context)
+            self.log.debug('modes: %s' % modes)
 
-        # Get request mode
-        modes = self._get_modes(context)
-        self.log.debug('modes: %s' % modes)
-
-        # Perform mode actions
-        self._do_actions(context, modes, req_data)
+            # Perform mode actions
+            self._do_actions(context, modes, req_data)
 
         # Fill up the template data.
         req_data['authname'] = context.req.authname
@@ -391,8 +878,7 @@ class DownloadsApi(Component):
         add_script(context.req, 'common/js/trac.js')
         add_script(context.req, 'common/js/wikitoolbar.js')
 
-        # Commit database changes and return template and data.
-        db.commit()
+        # Return template and data.
         return modes[-1] + '.html', {'downloads' : req_data}
 
     # Internal functions.
@@ -488,49 +974,40 @@ class DownloadsApi(Component):
                 # Check resource based permission.
                 context.req.perm.require('DOWNLOADS_VIEW', Resource('downloads', download['id']))
 
-                filename = os.path.basename(download['file'])
-                # Get download file path.
-                path = os.path.normpath(os.path.join(self.path, to_unicode(download['id']), filename))
-                self.log.debug('path: %s' % (path,))
-
-                # Increase downloads count.
-                new_download = {'count' : download['count'] + 1}
-
-                # Edit download.
-                self.edit_download(context, download['id'], new_download)
-
-                # Notify change listeners.
-                for listener in self.change_listeners:
-                    listener.download_changed(context, new_download,
-                      download)
-
-                # Commit DB before file send.
-                db = self.env.get_db_cnx()
-                db.commit()
+                # MIME type is detected when download is uploaded.
+                mime_type = self._get_content_type(download)
 
-                # Guess mime type.
-                file = open(path.encode('utf-8'), "r")
-                file_data = file.read(1000)
-                file.close()
-                mimeview = Mimeview(self.env)
-                mime_type = mimeview.get_mimetype(path, file_data)
-                if not mime_type:
-                    mime_type = 'application/octet-stream'
-                if 'charset=' not in mime_type:
-                    charset = mimeview.get_charset(file_data, mime_type)
-                    mime_type = mime_type + '; charset=' + charset
-
-                # Return uploaded file to request.
+                # Return uploaded file or its requested part to request.
                 context.req.send_header('Content-Disposition', 'attachment;filename="%s"' % (os.path.normpath(download['file'])))
                 context.req.send_header('Content-Description', download['description'])
-                try:
-                    context.req.send_file(path.encode('utf-8'), mime_type)
-                except RequestDone:
+                offload = self.storage.get_offload_header(download,
+                  self.offload, self.offload_prefix)
+                if offload:
+                    # Let front-end server transfer the file.
+                    status = transfer.offload_file(context.req, offload,
+                      download, mime_type)
+                else:
+                    if self.offload:
+                        self.log.warning('Cannot offload transfer of download'
+                          ' %s with mode %s' % (download['id'], self.offload))
+                    size = self.storage.stat(download).st_size
+                    file = self.storage.open(download)
                     try:
-                        for listener in self.download_listeners:
-                            listener.downloaded(context, download)
+                        status = transfer.send_file(context.req, file, size,
+                          download, mime_type)
                     finally:
-                        raise RequestDone
+                        file.close()
+
+                # Resumed transfers and cache revalidations are not counted
+                # as new downloads. Response is already sent in any case.
+                try:
+                    if transfer.is_new_download(context.req, status):
+                        # Downloads count is increased by DownloadsCounter
+                        # listener, download listeners are notified from
+                        # background thread.
+                        self.notify_downloaded(context, download)
+                finally:
+                    raise RequestDone
 
             elif action == 'downloads-list':
                 context.req.perm.require('DOWNLOADS_VIEW')
@@ -540,7 +1017,7 @@ class DownloadsApi(Component):
                 if context.req.args.has_key('desc'):
                     desc = context.req.args.get('desc') == '1'
                 else:
-                    desc = self.download_sort_direction
+                    desc = self.download_sort_direction == 'desc'
 
                 req_data['order'] = order
                 req_data['desc'] = desc
@@ -548,9 +1025,9 @@ class DownloadsApi(Component):
                 req_data['visible_fields'] = self.visible_fields
                 req_data['title'] = self.title
                 req_data['description'] = self.get_description(context)
-                req_data['downloads'] = self.get_downloads(context, order, desc)
-                req_data['visible_fields'] = [visible_field for visible_field
-                  in self.visible_fields]
+                self.fill_downloads_page(context, req_data, order, desc)
+                req_data['visible_fields'] = [(visible_field, None) for
+                  visible_field in self.visible_fields]
 
                 # Component, versions, etc. are needed only for new download
                 # add form.
@@ -568,7 +1045,7 @@ class DownloadsApi(Component):
                 if context.req.args.has_key('desc'):
                     desc = context.req.args.get('desc') == '1'
                 else:
-                    desc = self.download_sort_direction
+                    desc = self.download_sort_direction == 'desc'
                 download_id = safe_int(context.req.args.get('download', '0'))
 
                 req_data['supported_files'] = ', '.join(self.ext)
@@ -576,7 +1053,7 @@ class DownloadsApi(Component):
                 req_data['desc'] = desc
                 req_data['has_tags'] = self.env.is_component_enabled('tractags.api.TagEngine')
                 req_data['download'] = self.get_download(context, download_id)
-                req_data['downloads'] = self.get_downloads(context, order, desc)
+                self.fill_downloads_page(context, req_data, order, desc)
                 req_data['components'] = self.get_components(context)
                 req_data['versions'] = self.get_versions(context)
                 req_data['platforms'] = self.get_platforms(context)
@@ -647,7 +1124,7 @@ class DownloadsApi(Component):
                         download['size'] = file_size
                         download['author'] = context.req.authname
                         download['time'] = to_timestamp(datetime.now(utc))
-                        self._add_download(context, download, file, {'id': download_id, 'file': old_download['file']})
+                        self._add_download(context, download, file, old_download)
                     else:
                         # Edit Download.
                         self.edit_download(context, download_id, download)
@@ -801,6 +1278,16 @@ class DownloadsApi(Component):
                         type_id = safe_int(type_id)
                         self.delete_type(context, type_id)
 
+    def fill_downloads_page(self, context, req_data, order, desc, featured = False):
+        # Get requested page of downloads and keys of its neighbours.
+        downloads, previous_key, next_key = self.get_downloads_page(context,
+          order, desc, context.req.args.get('after'),
+          context.req.args.get('before'), featured)
+        req_data['downloads'] = downloads
+        req_data['paging'] = {'previous' : previous_key,
+                              'next' : next_key,
+                              'desc' : desc and '1' or '0'}
+
     def _add_download(self, context, download, file, old_download = None):
         """
         Full implementation of download addition. It creates DB entry for
@@ -813,84 +1300,189 @@ class DownloadsApi(Component):
                   ' unique file names are enabled.')
 
         # Check correct file type.
-        name, ext = os.path.splitext(download['file'])
-        if not 'all' in self.ext:
-            self.log.debug('file: %s file_ext: %s ext: %s' % (name, ext, self.ext))
-            if not ext[1:].lower() in self.ext:
-                raise TracError('Unsupported file type.')
+        self.check_file_type(download['file'])
 
-        # Check for maximum file size.
-        if self.max_size >= 0 and download['size'] > self.max_size:
+        # Reject too big file right away if its size is already known.
+        if self.max_size >= 0 and download.get('size', 0) > self.max_size:
             raise TracError('Maximum file size: %s bytes' % (self.max_size), 'Upload failed')
 
-        if old_download:
-            # Edit Download.
-            self.edit_download(context, old_download['id'], download)
-        else:
-            # Add new download to DB.
-            self.add_download(context, download)
-
-        # Get inserted download by time to get its ID.
-        download = self.get_download_by_time(context, download['time'])
+        # Copy uploaded file to downloads directory computing its size and
+        # checksums on the fly.
+        temp_path, size, checksums, head = self.ingest_file(file)
+        try:
+            download['size'] = size
+            download.update(checksums)
 
-        # Prepare file paths.
-        path = os.path.normpath(os.path.join(self.path, to_unicode(download['id'])))
-        filepath = os.path.normpath(os.path.join(path, download['file']))
+            # Detect MIME type once, it's stored with other download attributes.
+            download['mimetype'], download['charset'] = self.detect_mime_type(
+              download['file'], head)
 
-        # Remove old file, if exists
-        if old_download:
-            old_filename = None
+            if old_download:
+                # Edit Download.
+                self.edit_download(context, old_download['id'], download)
+                download = dict(download, id = old_download['id'])
+            else:
+                # Add new download to DB and complete its attributes.
+                download_id = self.add_download(context, download)
+                if download_id is None:
+                    raise TracError('Error storing file %s!' % (download['file'],))
+                download = dict(download, id = download_id)
+                for column in self.download_columns:
+                    download.setdefault(column, None)
+
+            # Move uploaded file to storage, replacing old file.
             try:
-                old_filename = os.path.basename(old_download['file'])
-                filepathold = os.path.normpath(os.path.join(path, old_filename))
-                os.remove(filepathold.encode('utf-8'))
+                self.storage.put(download, temp_path, old_download)
             except Exception, error:
-                self.log.exception("Error deleting old file %s, filename was '%s'",
-                    old_download['id'], old_filename)
-
-        # Store uploaded image.
-        try:
-            if not os.path.exists(path):
-                os.makedirs(path.encode('utf-8'))
-            out_file = open(filepath.encode('utf-8'), "wb+")
-            file.seek(0)
-            shutil.copyfileobj(file, out_file)
-            out_file.close()
-        except Exception, error:
-            self.delete_download(context, download['id'])
-            self.log.exception("Error storing file %s, %s", download['id'], download['name'])
-            try:
-                os.remove(filepath.encode('utf-8'))
-            except:
-                pass
-            try:
-                os.rmdir(path.encode('utf-8'))
-            except:
-                pass
-            raise TracError('Error storing file %s! Are downloads activated in project?' % (download['file'],))
+                self.delete_download(context, download['id'])
+                self.log.exception("Error storing file %s, %s", download['id'], download['file'])
+                raise TracError('Error storing file %s! Are downloads activated in project?' % (download['file'],))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
         if not old_download:
             # Notify change listeners.
             for listener in self.change_listeners:
                 listener.download_created(context, download)
 
+    def check_file_type(self, filename):
+        """
+        Raises TracError if extension of <filename> is not allowed.
+        """
+        name, ext = os.path.splitext(filename)
+        if not 'all' in self.ext:
+            self.log.debug('file: %s file_ext: %s ext: %s' % (name, ext, self.ext))
+            if not ext[1:].lower() in self.ext:
+                raise TracError('Unsupported file type.')
+
+    def notify_downloaded(self, context, download):
+        """
+        Notifies download listeners that file of <download> was downloaded.
+        """
+        for listener in self.download_listeners:
+            # Listeners with batch support get the event from background
+            # thread.
+            if self.async_download_events and hasattr(listener,
+              'downloaded_batch'):
+                continue
+            try:
+                listener.downloaded(context, download)
+            except Exception:
+                self.log.exception("Download listener %s failed",
+                  listener.__class__.__name__)
+        if self.async_download_events:
+            self.download_dispatcher.dispatch(DownloadEvent(download,
+              context.req.authname))
+
+    def get_file_checksums(self, file, out_file = None, max_size = -1):
+        """
+        Reads opened <file> and returns its size, dictionary with its
+        checksums and its first bytes. Read data are copied to <out_file> if
+        given. Reading stops with error as soon as file exceeds <max_size>
+        bytes if it is not negative.
+        """
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        size = 0
+        head = ''
+        while True:
+            data = file.read(transfer.chunk_size)
+            if not data:
+                break
+            size += len(data)
+            if max_size >= 0 and size > max_size:
+                raise TracError('Maximum file size: %s bytes' % (max_size), 'Upload failed')
+            if len(head) < 1000:
+                head += data[:1000 - len(head)]
+            sha256.update(data)
+            md5.update(data)
+            if out_file:
+                out_file.write(data)
+        return size, {'sha256' : sha256.hexdigest(), 'md5' : md5.hexdigest()}, head
+
+    def ingest_file(self, file, check_size = True):
+        """
+        Copies uploaded <file> to temporary file in downloads directory. Size
+        and checksums are computed in the same pass and upload is rejected as
+        soon as it exceeds maximum size if <check_size> is set. Returns path
+        of temporary file, file size, dictionary with checksums and first
+        bytes of file.
+        """
+        incoming_path = os.path.join(self.path, '.incoming').encode('utf-8')
+        try:
+            if not os.path.exists(incoming_path):
+                try:
+                    os.makedirs(incoming_path)
+                except OSError, error:
+                    # Directory could be created by concurrent upload.
+                    if error.errno != errno.EEXIST:
+                        raise
+            handle, temp_path = tempfile.mkstemp(dir = incoming_path)
+        except Exception, error:
+            self.log.exception("Cannot create temporary file in %s", incoming_path)
+            raise TracError('Error storing file! Are downloads activated in project?')
+
+        try:
+            out_file = os.fdopen(handle, 'wb')
+            try:
+                file.seek(0)
+                max_size = -1
+                if check_size:
+                    max_size = self.max_size
+                size, checksums, head = self.get_file_checksums(file, out_file,
+                  max_size)
+            finally:
+                out_file.close()
+            if size == 0:
+                raise TracError('Can\'t upload empty file.')
+        except:
+            os.remove(temp_path)
+            raise
+        return temp_path, size, checksums, head
+
     def _delete_download(self, context, download):
-        filename = None
         try:
             self.delete_download(context, download['id'])
-            path = os.path.join(self.path, to_unicode(safe_int(download['id'])))
-            filename = os.path.basename(download['file'])
-            filepath = os.path.join(path, filename)
-            path = os.path.normpath(path)
-            filepath = os.path.normpath(filepath)
-            os.remove(filepath)
-            os.rmdir(path)
+            self.storage.delete(download)
 
             # Notify change listeners.
             for listener in self.change_listeners:
                 listener.download_deleted(context, download)
         except:
-            self.log.exception("DownloadsPlugin: Cannot delete download %s, name: '%s'", download['id'], filename)
+            self.log.exception("DownloadsPlugin: Cannot delete download %s, name: '%s'", download['id'], download['file'])
+
+    def detect_mime_type(self, filename, data):
+        """
+        Returns MIME type and charset of file with <filename> according to its
+        leading <data>.
+        """
+        mimeview = Mimeview(self.env)
+        mime_type = mimeview.get_mimetype(filename, data)
+        if not mime_type:
+            mime_type = 'application/octet-stream'
+        if 'charset=' in mime_type:
+            mime_type, charset = mime_type.split('charset=', 1)
+            mime_type = mime_type.rstrip('; ')
+        else:
+            charset = mimeview.get_charset(data, mime_type)
+        return mime_type, charset
+
+    def _get_content_type(self, download):
+        mime_type, charset = download['mimetype'], download['charset']
+        if not mime_type:
+            # Download was uploaded before MIME types were stored, detect it
+            # from file. Stored value can be filled by trac-admin download
+            # backfill command.
+            file = self.storage.open(download)
+            try:
+                mime_type, charset = self.detect_mime_type(download['file'],
+                  file.read(1000))
+            finally:
+                file.close()
+        if charset:
+            return mime_type + '; charset=' + charset
+        return mime_type
 
     def _get_file_from_req(self, context):
         file = context.req.args['file']
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import atexit
+from threading import Thread, Event, Lock
+
+class Flusher(object):
+    """
+    Background thread which periodically calls flush function of a buffered
+    writer. Flush can be also requested immediately, for example when the
+    buffer reaches its size limit. Buffered data are flushed once more when
+    the interpreter exits.
+    """
+    def __init__(self, name, flush, log, interval = 10):
+        self.name = name
+        self.flush = flush
+        self.log = log
+        self.interval = interval
+        self.thread = None
+        self.event = Event()
+        self.lock = Lock()
+        self.stopped = False
+
+    def start(self):
+        """
+        Starts background thread if it's not running yet.
+        """
+        self.lock.acquire()
+        try:
+            if self.thread or self.stopped:
+                return
+            self.thread = Thread(target = self._run, name = self.name)
+            self.thread.setDaemon(True)
+            self.thread.start()
+            atexit.register(self.stop)
+        finally:
+            self.lock.release()
+
+    def wake(self):
+        """
+        Requests immediate flush from background thread.
+        """
+        self.start()
+        self.event.set()
+
+    def stop(self, timeout = 10):
+        """
+        Stops background thread and flushes remaining data.
+        """
+        self.lock.acquire()
+        try:
+            if self.stopped:
+                return
+            self.stopped = True
+            thread = self.thread
+        finally:
+            self.lock.release()
+        if thread:
+            self.event.set()
+            thread.join(timeout)
+        self._flush()
+
+    def _run(self):
+        while not self.stopped:
+            self.event.wait(self.interval)
+            self.event.clear()
+            if not self.stopped:
+                self._flush()
+
+    def _flush(self):
+        # Background thread must survive any error of flush function.
+        try:
+            self.flush()
+        except Exception:
+            self.log.exception("%s: Flush failed", self.name)
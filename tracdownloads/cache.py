@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import time
+from threading import Lock
+
+class Cache(object):
+    """
+    Simple thread safe in-memory cache. Items are computed by retriever
+    function on first access and kept until they are invalidated or until
+    their time to live expires. Cache with limited <size> is cleared when it
+    becomes full.
+    """
+    def __init__(self, size = 0):
+        self.items = {}
+        self.size = size
+        self.generation = 0
+        self.lock = Lock()
+
+    def get(self, key, retriever, ttl = 0):
+        """
+        Returns cached value of <key>. Calls <retriever> to compute it if it's
+        not cached yet or if it's older than <ttl> seconds. Zero <ttl> means
+        unlimited lifetime.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            item = self.items.get(key)
+            generation = self.generation
+        finally:
+            self.lock.release()
+        if item and (ttl <= 0 or now - item[1] < ttl):
+            return item[0]
+
+        # Value is computed outside of the lock, concurrent retrievals of the
+        # same key are harmless. Value retrieved before invalidation could be
+        # outdated, it's returned but not stored.
+        value = retriever()
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return value
+            if self.size and len(self.items) >= self.size and \
+              not self.items.has_key(key):
+                self.items.clear()
+            self.items[key] = (value, now)
+        finally:
+            self.lock.release()
+        return value
+
+    def invalidate(self, key = None):
+        """
+        Removes <key> from cache or clears whole cache if no <key> is given.
+        """
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if key is None:
+                self.items.clear()
+            else:
+                self.items.pop(key, None)
+        finally:
+            self.lock.release()
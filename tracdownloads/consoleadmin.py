@@ -1,19 +1,29 @@
 # -*- coding: utf8 -*-
 
 import os.path
+import sys, re, csv, time
 import unicodedata
+from multiprocessing.pool import ThreadPool
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 from trac.core import Component, implements, ExtensionPoint, TracError
 from trac.admin import AdminCommandError
 from trac.perm import PermissionCache
 from trac.mimeview import Context
 from trac.util.translation import _
-from trac.util.text import to_unicode, print_table, pretty_size
-from trac.util.datefmt import to_timestamp, utc, datetime, format_datetime
+from trac.util.text import to_unicode, print_table, printout, pretty_size
+from trac.util.datefmt import to_timestamp, utc, datetime, format_datetime, \
+  parse_date
 from trac.admin import IAdminCommandProvider
-from trac.config import Option
+from trac.config import Option, IntOption
 
-from api import DownloadsApi, IDownloadChangeListener
+from api import DownloadsApi, IDownloadChangeListener, IDownloadStorage, \
+  database_context
+from storage import LocalDownloadsStorage
+from stats import load_stats, remove_stats
 from multiproject.core.configuration import conf
 
 class FakeRequest(object):
@@ -30,40 +40,148 @@ class DownloadsConsoleAdmin(Component):
     # Download change listeners.
     change_listeners = ExtensionPoint(IDownloadChangeListener)
 
+    # Download file storages.
+    storages = ExtensionPoint(IDownloadStorage)
+
     # Configuration options.
     consoleadmin_user = Option('downloads', 'consoleadmin_user', 'anonymous',
       doc = 'User whos permissons will be used to upload download. User should have TAGS_MODIFY permissons.')
+    import_workers = IntOption('downloads', 'import_workers', 4,
+      doc = 'Number of threads which copy and checksum files imported by trac-admin download import command.')
+
+    # Columns of download list in CSV and JSON format.
+    list_columns = ('id', 'file', 'description', 'size', 'time', 'count',
+      'author', 'tags', 'component', 'version', 'platform', 'type', 'featured',
+      'mimetype', 'charset', 'sha256', 'md5')
+
+    # Download list filters and conditions they are translated to.
+    list_filters = {'component' : 'd.component = %s',
+                    'version' : 'd.version = %s',
+                    'platform' : 'p.name = %s',
+                    'type' : 't.name = %s',
+                    'from' : 'd.time >= %s',
+                    'to' : 'd.time <= %s'}
+
+    # Download attributes which can be set from command line or manifest.
+    attribute_names = ('description', 'author', 'tags', 'component', 'version', 'platform', 'type')
 
     # IAdminCommandProvider
 
     def get_admin_commands(self):
-        yield ('download list', '', 'Show uploaded downloads', None, self._do_list)
+        yield ('download list', '[--format=table|csv|json]'
+          ' [--component=<component>]\n  [--version=<version>]'
+          ' [--platform=<platform>] [--type=<type>]\n  [--from=<date>]'
+          ' [--to=<date>] [--featured]', 'Show uploaded downloads matching'
+          ' all given filters. Date without time in --to filter includes'
+          ' the whole day. CSV and JSON output is written as rows are read'
+          ' from database, except on MySQL and PostgreSQL where database'
+          ' client reads all rows first.', None, self._do_list)
         yield ('download add', '<file> [description=<description>]'
           ' [author=<author>]\n  [tags="<tag1> <tag2> ..."]'
           ' [component=<component>] [version=<version>]\n'
           ' [platform=<platform>]'
           ' [type=<type>]', 'Add new download', None,
           self._do_add)
+        yield ('download import', '<directory> | <manifest>'
+          ' [<attribute>=<value> ...]',
+          'Add all files of directory or files listed in CSV or JSON manifest'
+          ' with attributes of downloads. Attributes given on command line are'
+          ' defaults for all files. Nothing is added if any file fails.', None,
+          self._do_import)
         yield ('download remove', '<filename> | <download_id>',
           'Remove uploaded download', None, self._do_remove)
+        yield ('download backfill', '',
+          'Detect and store MIME type, charset, size and checksums of downloads'
+          ' uploaded before they were stored', None, self._do_backfill)
+        yield ('download dedupe', '',
+          'Replace stored files with identical content by links to shared'
+          ' blobs', None, self._do_dedupe)
+        yield ('download migrate', '<storage>',
+          'Move files of all downloads to another storage', None,
+          self._do_migrate)
+        yield ('download stats', '[reset]',
+          'Show database query statistics saved by server processes or'
+          ' remove them', None, self._do_stats)
 
     # Internal methods.
 
-    def _do_list(self):
+    def _do_list(self, *arguments):
         # Get downloads API component.
         api = self.env[DownloadsApi]
 
+        # Read output format and filters from arguments.
+        format = 'table'
+        conditions = []
+        values = []
+        for argument in arguments:
+            if argument == '--featured':
+                conditions.append('d.featured = 1')
+                continue
+            if not argument.startswith('--') or not '=' in argument:
+                raise AdminCommandError(_('Invalid argument: %(value)s',
+                  value = argument))
+            name, value = argument[2:].split('=', 1)
+            value = to_unicode(value, 'utf-8')
+            if name == 'format':
+                if not value in ('table', 'csv', 'json'):
+                    raise AdminCommandError(_('Invalid output format:'
+                      ' %(value)s', value = value))
+                format = value
+                continue
+            if not self.list_filters.has_key(name):
+                raise AdminCommandError(_('Invalid filter: %(value)s',
+                  value = name))
+            if name in ('from', 'to'):
+                try:
+                    timestamp = to_timestamp(parse_date(value, utc))
+                except TracError, error:
+                    raise AdminCommandError(to_unicode(error))
+                # Date without time means the end of the day in --to filter.
+                if name == 'to' and re.match(r'''^\d{4}-\d{2}-\d{2}$''',
+                  value.strip()):
+                    timestamp += 86399
+                value = timestamp
+            conditions.append(self.list_filters[name])
+            values.append(value)
+
         # Create context.
         context = Context('downloads-consoleadmin')
-        db = self.env.get_db_cnx()
-        context.cursor = db.cursor()
-
-        # Print uploded download
-        downloads = api.get_downloads(context)
-        print_table([(download['id'], download['file'], pretty_size(
-          download['size']), format_datetime(download['time']), download['component'], download['version'],
-          download['platform']['name'], download['type']['name']) for download in downloads], ['ID',
-          'Filename', 'Size', 'Uploaded', 'Component', 'Version', 'Platform', 'Type'])
+        with database_context(self.env, context):
+            # Downloads are read from one joined query.
+            downloads = api.iter_downloads(context, ' AND '.join(conditions),
+              tuple(values))
+            if format == 'csv':
+                writer = csv.writer(sys.stdout)
+                writer.writerow(self.list_columns)
+                for download in downloads:
+                    row = []
+                    for value in self._get_list_row(download):
+                        if value is None:
+                            value = ''
+                        row.append(to_unicode(value).encode('utf-8'))
+                    writer.writerow(row)
+            elif format == 'json':
+                # Array is written item by item.
+                separator = '['
+                for download in downloads:
+                    sys.stdout.write(separator + '\n' + json.dumps(dict(zip(
+                      self.list_columns, self._get_list_row(download)))))
+                    separator = ','
+                sys.stdout.write(separator == '[' and '[]\n' or '\n]\n')
+            else:
+                # Print uploded download
+                print_table([(download['id'], download['file'], pretty_size(
+                  download['size']), format_datetime(download['time']), download['component'], download['version'],
+                  download['platform']['name'], download['type']['name']) for download in downloads], ['ID',
+                  'Filename', 'Size', 'Uploaded', 'Component', 'Version', 'Platform', 'Type'])
+
+    def _get_list_row(self, download):
+        # Returns values of download list columns with names of platform and
+        # type and ISO 8601 upload time.
+        download = dict(download, platform = download['platform']['name'],
+          type = download['type']['name'], time = download['time'] and
+          format_datetime(download['time'], 'iso8601', utc))
+        return [download[column] for column in self.list_columns]
 
     def _do_add(self, filename, *arguments):
         # Get downloads API component.
@@ -71,97 +189,422 @@ class DownloadsConsoleAdmin(Component):
 
         # Create context.
         context = Context('downloads-consoleadmin')
-        db = self.env.get_db_cnx()
-        context.cursor = db.cursor()
         context.req = FakeRequest(self.env, self.consoleadmin_user)
+        with database_context(self.env, context, commit = True):
+            # Be sure, we have correct path
+            req_path = conf.getEnvironmentDownloadsPath(self.env)
+
+            # Convert relative path to absolute.
+            if not os.path.isabs(filename):
+                filename = os.path.join(req_path, filename)
+
+            # Open file object.
+            file, filename, file_size = self._get_file(filename)
+            try:
+                # Create download dictionary from arbitrary attributes.
+                download = {'file' : filename,
+                            'size' : file_size,
+                            'time' : to_timestamp(datetime.now(utc)),
+                            'count' : 0}
+
+                # Read optional attributes from arguments.
+                download.update(self._get_attributes(context,
+                  self._parse_arguments(arguments)))
+
+                self.log.debug(download)
+
+                # Upload file to DB and file storage.
+                api._add_download(context, download, file)
+            finally:
+                # Close input file.
+                file.close()
+
+    def _do_import(self, source, *arguments):
+        # Get downloads API component.
+        api = self.env[DownloadsApi]
+        start = time.time()
+
+        # Create context.
+        context = Context('downloads-consoleadmin')
+        context.req = FakeRequest(self.env, self.consoleadmin_user)
+        with database_context(self.env, context, commit = True):
+            # Platform and type names of all files are resolved from maps
+            # loaded once.
+            platforms = dict([(platform['name'], platform['id']) for platform
+              in api.get_platforms(context)])
+            types = dict([(type['name'], type['id']) for type in
+              api.get_types(context)])
+            defaults = self._get_attributes(context, self._parse_arguments(
+              arguments), platforms, types)
+
+            # Existing file names are loaded only if they have to be unique.
+            files = set()
+            if api.unique_filename:
+                files.update([item['file'] for item in api.get_download_files(
+                  context)])
+
+            # Validate all files before anything is copied.
+            paths = []
+            downloads = []
+            for entry in self._get_import_entries(source):
+                path = entry.pop('file')
+                filename = self._normalize_filename(path)
+                if not os.path.isfile(path):
+                    raise AdminCommandError(_('File not found: %(path)s',
+                      path = path))
+                try:
+                    api.check_file_type(filename)
+                except TracError, error:
+                    raise AdminCommandError(_('Cannot import %(path)s: %(error)s',
+                      path = path, error = to_unicode(error)))
+                if filename in files:
+                    raise AdminCommandError(_('File with name %(name)s is'
+                      ' already uploaded or imported.', name = filename))
+                if api.unique_filename:
+                    files.add(filename)
+                download = dict(defaults)
+                download.update(self._get_attributes(context, entry.items(),
+                  platforms, types))
+                download['file'] = filename
+                paths.append(path)
+                downloads.append(download)
+            if not downloads:
+                raise AdminCommandError(_('No files to import in %(source)s.',
+                  source = source))
+
+            # Copy files to downloads directory and compute their checksums
+            # in parallel.
+            def ingest(path):
+                try:
+                    file = open(path, 'rb')
+                    try:
+                        return api.ingest_file(file), None
+                    finally:
+                        file.close()
+                except Exception, error:
+                    return None, '%s: %s' % (path, to_unicode(error))
+            pool = ThreadPool(max(self.import_workers, 1))
+            try:
+                results = pool.map(ingest, paths)
+            finally:
+                pool.close()
+                pool.join()
+            temp_paths = [result[0] for result, error in results if result]
+
+            stored = []
+            try:
+                errors = [error for result, error in results if error]
+                if errors:
+                    raise AdminCommandError(_('Cannot import files:\n%(errors)s',
+                      errors = '\n'.join(errors)))
+
+                # Add all downloads in one transaction and move their files to
+                # storage.
+                for download, (result, error) in zip(downloads, results):
+                    temp_path, size, checksums, head = result
+                    download.update(checksums)
+                    download['size'] = size
+                    download['time'] = to_timestamp(datetime.now(utc))
+                    download['count'] = 0
+                    download['mimetype'], download['charset'] = \
+                      api.detect_mime_type(download['file'], head)
+                    download_id = api.add_download(context, download)
+                    if download_id is None:
+                        raise AdminCommandError(_('Cannot add download %(name)s.',
+                          name = download['file']))
+                    download = dict(download, id = download_id)
+                    for column in api.download_columns:
+                        download.setdefault(column, None)
+                    api.storage.put(download, temp_path)
+                    stored.append(download)
+            except:
+                # Transaction is rolled back, remove already stored files.
+                for download in stored:
+                    try:
+                        api.storage.delete(download)
+                    except Exception:
+                        self.log.exception("Cannot remove file of download %s,"
+                          " name: '%s'", download['id'], download['file'])
+                raise
+            finally:
+                for temp_path in temp_paths:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+
+            # Notify change listeners.
+            for download in stored:
+                for listener in self.change_listeners:
+                    listener.download_created(context, download)
+
+        # Report throughput.
+        elapsed = max(time.time() - start, 0.001)
+        size = sum([download['size'] for download in stored])
+        printout(_('%(count)s downloads imported, %(size)s in %(time).1f s'
+          ' (%(files).1f files/s, %(rate)s/s).', count = len(stored),
+          size = pretty_size(size), time = elapsed, files = len(stored) /
+          elapsed, rate = pretty_size(size / elapsed)))
 
-        # Be sure, we have correct path
-        req_path = conf.getEnvironmentDownloadsPath(self.env)
+    def _do_remove(self, identifier):
+        # Get downloads API component.
+        api = self.env[DownloadsApi]
 
-        # Convert relative path to absolute.
-        if not os.path.isabs(filename):
-            filename = os.path.join(req_path, filename)
+        # Create context.
+        context = Context('downloads-consoleadmin')
+        context.req = FakeRequest(self.env, self.consoleadmin_user)
+        with database_context(self.env, context, commit = True):
+            # Get download by ID or filename.
+            try:
+                download_id = int(identifier)
+                download = api.get_download(context, download_id)
+            except ValueError:
+                download = api.get_download_by_file(context, identifier)
+
+            # Check if download exists.
+            if not download:
+                raise AdminCommandError(_('Invalid download identifier: %(value)s', value = identifier))
+
+            # Delete download by ID.
+            api._delete_download(context, download)
+
+    def _do_backfill(self):
+        # Get downloads API component.
+        api = self.env[DownloadsApi]
 
-        # Open file object.
-        file, filename, file_size = self._get_file(filename)
+        # Create context.
+        context = Context('downloads-consoleadmin')
+        with database_context(self.env, context, commit = True):
+            # Detect missing attributes from stored files.
+            count = 0
+            for download in api.get_downloads(context):
+                if download['mimetype'] and download['sha256']:
+                    continue
+                try:
+                    file = api.storage.open(download)
+                    try:
+                        size, checksums, head = api.get_file_checksums(file)
+                    finally:
+                        file.close()
+                except (IOError, OSError), error:
+                    printout(_('Cannot read file of download %(id)s: %(error)s',
+                      id = download['id'], error = to_unicode(error)))
+                    continue
+                mime_type, charset = api.detect_mime_type(download['file'], head)
+                changes = {'mimetype' : mime_type, 'charset' : charset, 'size' : size}
+                changes.update(checksums)
+                api.edit_download(context, download['id'], changes)
+                count += 1
+
+            printout(_('%(count)s downloads updated.', count = count))
+
+    def _do_dedupe(self):
+        # Get downloads API component.
+        api = self.env[DownloadsApi]
+        if not isinstance(api.storage, LocalDownloadsStorage) or \
+          not api.storage.dedupe:
+            raise AdminCommandError(_('Deduplication is not enabled, set'
+              ' [downloads] dedupe option first.'))
 
-        # Create download dictionary from arbitrary attributes.
-        download = {'file' : filename,
-                    'size' : file_size,
-                    'time' : to_timestamp(datetime.now(utc)),
-                    'count' : 0}
+        # Create context.
+        context = Context('downloads-consoleadmin')
+        with database_context(self.env, context):
+            # Link files of all downloads with known checksum to blobs.
+            count = 0
+            freed = 0
+            for download in api.get_downloads(context):
+                if not download['sha256']:
+                    printout(_('Download %(id)s has no checksum, run download'
+                      ' backfill first.', id = download['id']))
+                    continue
+                try:
+                    freed += api.storage.dedupe_file(download)
+                except (IOError, OSError), error:
+                    printout(_('Cannot deduplicate file of download %(id)s:'
+                      ' %(error)s', id = download['id'], error = to_unicode(error)))
+                    continue
+                count += 1
+            printout(_('%(count)s downloads deduplicated, %(size)s freed.',
+              count = count, size = pretty_size(freed)))
+
+    def _do_migrate(self, storage_name):
+        # Get downloads API component and target storage.
+        api = self.env[DownloadsApi]
+        storages = dict([(storage.__class__.__name__, storage) for storage in
+          self.storages])
+        if not storages.has_key(storage_name):
+            raise AdminCommandError(_('Unknown storage %(name)s, possible'
+              ' values are: %(names)s', name = storage_name,
+              names = ', '.join(sorted(storages.keys()))))
+        target = storages[storage_name]
+        if target is api.storage:
+            raise AdminCommandError(_('Files are already stored by'
+              ' %(name)s.', name = storage_name))
 
-        # Read optional attributes from arguments.
+        # Create context.
+        context = Context('downloads-consoleadmin')
+        with database_context(self.env, context):
+            # Copy file of each download to target storage and remove it from
+            # current one.
+            count = 0
+            for download in api.get_downloads(context):
+                try:
+                    file = api.storage.open(download)
+                    try:
+                        temp_path = api.ingest_file(file, False)[0]
+                    finally:
+                        file.close()
+                    try:
+                        target.put(download, temp_path)
+                    finally:
+                        if os.path.exists(temp_path):
+                            os.remove(temp_path)
+                    api.storage.delete(download)
+                except (IOError, OSError), error:
+                    printout(_('Cannot move file of download %(id)s: %(error)s',
+                      id = download['id'], error = to_unicode(error)))
+                    continue
+                count += 1
+            printout(_('%(count)s downloads moved, set [downloads] storage option'
+              ' to %(name)s now.', count = count, name = storage_name))
+
+    def _do_stats(self, action = None):
+        # Get downloads API component.
+        api = self.env[DownloadsApi]
+        directory = api.get_stats_directory()
+
+        # Remove saved statistics.
+        if action == 'reset':
+            remove_stats(directory)
+            return
+        elif action:
+            raise AdminCommandError(_('Invalid stats action: %(value)s',
+              value = action))
+
+        # Print per page statistics sorted by queries per request.
+        stats = load_stats(directory)
+        if not stats['started']:
+            printout(_('No query statistics saved yet.'))
+            return
+        printout(_('Queries since %(time)s:', time = format_datetime(
+          stats['started'])))
+        pages = sorted(stats['pages'], key = lambda page: float(page['queries'])
+          / page['requests'], reverse = True)
+        print_table([(page['page'], page['requests'], '%.1f' % (float(
+          page['queries']) / page['requests']), page['max_queries'], '%.1f' %
+          (page['time'] * 1000.0 / page['requests']), '%.1f' % (float(
+          page['rows']) / page['requests'])) for page in pages], ['Page',
+          'Requests', 'Queries', 'Max queries', 'Time [ms]', 'Rows'])
+
+        # Print latest slow queries.
+        if stats['slow_queries']:
+            printout(_('Slow queries:'))
+            print_table([(format_datetime(query['when']), query['page'], '%.1f' %
+              (query['time'] * 1000.0), query['rows'], query['sql']) for query
+              in stats['slow_queries'][-20:]], ['Time', 'Page', 'Duration [ms]',
+              'Rows', 'Query'])
+
+    def _parse_arguments(self, arguments):
+        # Splits command line arguments to attribute names and values.
+        items = []
         for argument in arguments:
             # Check correct format.
-            argument = argument.split("=")
+            argument = argument.split('=', 1)
             if len(argument) != 2:
-                AdminCommandError(_('Invalid format of download attribute:'
-                  ' %(value)s', value = argument))
-            name, value = argument
-
-            # Check known arguments.
-            if not name in ('description', 'author', 'tags', 'component', 'version', 'platform', 'type'):
+                raise AdminCommandError(_('Invalid format of download attribute:'
+                  ' %(value)s', value = argument[0]))
+            items.append(tuple(argument))
+        return items
+
+    def _get_attributes(self, context, items, platforms = None, types = None):
+        """
+        Returns download attributes from sequence of their names and values.
+        Platform and type names are transformed to IDs using <platforms> and
+        <types> maps or cached metadata if maps are not given.
+        """
+        api = self.env[DownloadsApi]
+        if platforms is None:
+            platforms = dict([(platform['name'], platform['id']) for platform
+              in api.get_platforms(context)])
+        if types is None:
+            types = dict([(type['name'], type['id']) for type in
+              api.get_types(context)])
+
+        attributes = {}
+        for name, value in items:
+            # Check known arguments.
+            if not name in self.attribute_names:
                 raise AdminCommandError(_('Invalid download attribute: %(value)s', value = name))
 
             # Transform platform and type name to ID.
+            value = to_unicode(value, 'utf-8')
             if name == 'platform':
-                value = api.get_platform_by_name(context, value)['id']
+                if not platforms.has_key(value):
+                    raise AdminCommandError(_('Unknown platform: %(value)s', value = value))
+                value = platforms[value]
             elif name == 'type':
-                value = api.get_type_by_name(context, value)['id']
-
-            # Add attribute to download.
-            download[name] = value
-
-        self.log.debug(download)
-
-        # Upload file to DB and file storage.
-        api.store_download(context, download, file)
-
-        # Close input file and commit changes in DB.
-        file.close()
-        db.commit()
-
-    def _do_remove(self, identifier):
-        # Get downloads API component.
-        api = self.env[DownloadsApi]
-
-        # Create context.
-        context = Context('downloads-consoleadmin')
-        db = self.env.get_db_cnx()
-        context.cursor = db.cursor()
-        context.req = FakeRequest(self.env, self.consoleadmin_user)
-
-        # Get download by ID or filename.
+                if not types.has_key(value):
+                    raise AdminCommandError(_('Unknown type: %(value)s', value = value))
+                value = types[value]
+
+            # Add attribute to download.
+            attributes[name] = value
+        return attributes
+
+    def _get_import_entries(self, source):
+        """
+        Returns list of dictionaries with path and attributes of each file to
+        import from <source> directory or manifest. Paths in manifest are
+        relative to its directory.
+        """
+        source = os.path.abspath(source)
+        entries = []
+        if os.path.isdir(source):
+            # Hidden files and directories are skipped.
+            for root, directories, files in os.walk(source):
+                directories[:] = sorted([directory for directory in directories
+                  if not directory.startswith('.')])
+                for name in sorted(files):
+                    if not name.startswith('.'):
+                        entries.append({'file' : os.path.join(root, name)})
+            return entries
+
+        # Read manifest in CSV or JSON format.
         try:
-            download_id = int(identifier)
-            download = api.get_download(context, download_id)
-        except ValueError:
-            download = api.get_download_by_file(context, identifier)
-
-        # Check if download exists.
-        if not download:
-            raise AdminCommandError(_('Invalid download identifier: %(value)s', value = identifier))
-
-        # Delete download by ID.
-        api.remove_download(context, download)
-
-        # Commit changes in DB.
-        db.commit()
+            file = open(source, 'rb')
+            try:
+                if source.lower().endswith('.json'):
+                    items = json.load(file)
+                else:
+                    items = [dict([(name, value) for name, value in row.items()
+                      if name and value]) for row in csv.DictReader(file)]
+            finally:
+                file.close()
+        except (IOError, ValueError, csv.Error), error:
+            raise AdminCommandError(_('Cannot read manifest %(source)s:'
+              ' %(error)s', source = source, error = to_unicode(error)))
+        directory = os.path.dirname(source)
+        for item in items:
+            if not isinstance(item, dict) or not item.get('file'):
+                raise AdminCommandError(_('Manifest entry without file: %(entry)s',
+                  entry = item))
+            entry = dict([(str(name), value) for name, value in item.items()])
+            entry['file'] = os.path.join(directory, entry['file'])
+            entries.append(entry)
+        return entries
 
     def _get_file(self, filename):
         # Open file and get its size
         file = open(filename, 'rb')
         size = os.fstat(file.fileno())[6]
 
-        # Check non-emtpy file.
+        # Check non-emtpy file.
         if size == 0:
             raise TracError('Can\'t upload empty file.')
 
+        return file, self._normalize_filename(filename), size
+
+    def _normalize_filename(self, filename):
         # Try to normalize the filename to unicode NFC if we can.
         # Files uploaded from OS X might be in NFD.
         filename = unicodedata.normalize('NFC', to_unicode(filename, 'utf-8'))
         filename = filename.replace('\\', '/').replace(':', '/')
-        filename = os.path.basename(filename)
-
-        return file, filename, size
+        return os.path.basename(filename)
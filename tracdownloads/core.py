@@ -2,15 +2,18 @@
 
 # Standard imports.
 import re
+from datetime import datetime
+from threading import Lock
 
 from pkg_resources import resource_filename #@UnresolvedImport
 
 # Trac imports
 from trac.core import Component, implements
-from trac.config import Option
+from trac.config import Option, IntOption
 from trac.mimeview import Context
 from trac.util.html import html
 from trac.util.text import pretty_size
+from trac.util.datefmt import utc, to_timestamp
 from trac.util.translation import domain_functions
 
 # Trac interfaces.
@@ -23,7 +26,9 @@ from trac.perm import IPermissionRequestor
 from multiproject.core.configuration import conf
 
 # Local imports.
-from api import DownloadsApi, IDownloadListener
+from api import DownloadsApi, IDownloadListener, database_context
+from batch import Flusher
+from dispatch import DownloadEvent
 
 # Bring in dedicated Trac plugin i18n helper.
 from multiproject.core.db import safe_int
@@ -88,12 +93,11 @@ class DownloadsCore(Component):
       context = None, **kwargs):
         # Create context.
         context = Context('downloads-core')
-        db = self.env.get_db_cnx()
-        context.cursor = db.cursor()
 
         # Get download from ID.
         api = self.env[DownloadsApi]
-        download = api.get_download(context, safe_int(resource.id))
+        with database_context(self.env, context):
+            download = api.get_download(context, safe_int(resource.id))
 
         if format == 'compact':
             return download['file']
@@ -104,28 +108,123 @@ class DownloadsCore(Component):
 
 class DownloadsLog(Component):
     """
-        The tracing module
+        The tracing module. Download records are collected in memory and
+        written to download_log table in batches from background thread.
     """
     implements(IDownloadListener)
 
+    # Configuration options.
+    flush_interval = IntOption('downloads', 'log_flush_interval', 10,
+      'Number of seconds after which collected download tracking records are written to database.')
+    flush_size = IntOption('downloads', 'log_flush_size', 100,
+      'Number of collected download tracking records which causes their immediate write to database.')
+
+    # Maximum number of user IDs remembered and rows inserted by one query.
+    user_cache_size = 1000
+    insert_size = 500
+
+    def __init__(self):
+        self.records = []
+        self.user_ids = {}
+        self.lock = Lock()
+        self.flusher = Flusher('DownloadsLog', self.flush, self.log,
+          self.flush_interval)
+
     def downloaded(self, context, download):
         """Called when a file is downloaded
         """
-        store = conf.getUserStore()
-        user = store.getUser(context.req.authname)
+        self.downloaded_batch([DownloadEvent(download, context.req.authname)])
+
+    def downloaded_batch(self, events):
+        records = [(safe_int(event.download['id']), event.authname,
+          to_timestamp(event.time)) for event in events]
+        self.lock.acquire()
+        try:
+            self.records.extend(records)
+            full = len(self.records) >= self.flush_size
+        finally:
+            self.lock.release()
+        if self.flusher.stopped:
+            # Interpreter exits, write records right away.
+            self.flush()
+        elif full:
+            self.flusher.wake()
+        else:
+            self.flusher.start()
+
+    def flush(self):
+        """
+        Writes collected download records to database.
+        """
+        self.lock.acquire()
+        try:
+            records = self.records
+            self.records = []
+        finally:
+            self.lock.release()
+        if not records:
+            return
+
+        # Resolve user names to IDs, duplicate rows would violate primary key.
+        # Rows store age of download in seconds, timestamps are computed by
+        # database clock as if rows were inserted right away.
+        now = to_timestamp(datetime.now(utc))
+        rows = []
+        seen = set()
+        for release_id, username, timestamp in records:
+            user_id = self._get_user_id(username)
+            if user_id is None:
+                self.log.debug("Cannot resolve user %s for tracking data." % (username,))
+                continue
+            if (release_id, user_id, timestamp) not in seen:
+                seen.add((release_id, user_id, timestamp))
+                rows.append((release_id, user_id, max(now - timestamp, 0)))
 
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-
-        query = "INSERT INTO download_log (release_id,user_id) VALUES(%u,%u)" % \
-                  (safe_int(download['id']), safe_int(user.id))
-
         try:
-            cursor.execute(query)
-            db.commit()
-        except:
-            self.env.log.debug("Cannot update tracking data. query=[%s]" % query)
+            for start in xrange(0, len(rows), self.insert_size):
+                self._insert_rows(db, cursor, rows[start:start + self.insert_size])
         finally:
             cursor.close()
             db.close()
 
+    def _insert_rows(self, db, cursor, rows):
+        query = "INSERT INTO download_log (release_id, user_id, timestamp) VALUES " + \
+          ", ".join(["(%s, %s, CURRENT_TIMESTAMP - INTERVAL %s SECOND)"] * len(rows))
+        values = [value for row in rows for value in row]
+        try:
+            cursor.execute(query, values)
+            db.commit()
+            return
+        except:
+            self.log.debug("Cannot insert tracking data in batch. query=[%s]" % query)
+            db.rollback()
+
+        # Insert rows one by one so one conflicting row doesn't drop the
+        # others.
+        query = "INSERT INTO download_log (release_id, user_id, timestamp) VALUES" \
+          " (%s, %s, CURRENT_TIMESTAMP - INTERVAL %s SECOND)"
+        for row in rows:
+            try:
+                cursor.execute(query, row)
+                db.commit()
+            except:
+                self.log.debug("Cannot update tracking data. query=[%s], values=%s" % (query, row))
+                db.rollback()
+
+    def _get_user_id(self, username):
+        if username in self.user_ids:
+            return self.user_ids[username]
+        user = conf.getUserStore().getUser(username)
+        user_id = user and safe_int(user.id)
+
+        # Unknown user is not cached, it could be created later.
+        if user_id is None:
+            return None
+
+        # Keep cache small, it's enough to hold recently active users.
+        if len(self.user_ids) >= self.user_cache_size:
+            self.user_ids.clear()
+        self.user_ids[username] = user_id
+        return user_id
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+from threading import Lock
+
+# Trac imports.
+from trac.core import Component, implements
+from trac.config import IntOption
+
+# Local imports.
+from api import IDownloadListener
+from batch import Flusher
+
+class DownloadsCounter(Component):
+    """
+        The counter module collects download count increments in memory and
+        writes them to database in batches from background thread.
+    """
+    implements(IDownloadListener)
+
+    # Configuration options.
+    flush_interval = IntOption('downloads', 'counter_flush_interval', 10,
+      'Number of seconds after which collected download counts are written to database.')
+    flush_size = IntOption('downloads', 'counter_flush_size', 100,
+      'Number of collected downloads which causes immediate write of download counts to database.')
+
+    def __init__(self):
+        self.pending = {}
+        self.pending_total = 0
+        self.flushing = {}
+        self.generation = 0
+        self.lock = Lock()
+        self.flusher = Flusher('DownloadsCounter', self.flush, self.log,
+          self.flush_interval)
+
+    # IDownloadListener methods.
+
+    def downloaded(self, context, download):
+        self.increment(download['id'])
+
+    def downloaded_batch(self, events):
+        counts = {}
+        for event in events:
+            download_id = event.download['id']
+            counts[download_id] = counts.get(download_id, 0) + 1
+        self.increment_counts(counts)
+
+    # Public methods.
+
+    def increment(self, download_id, count = 1):
+        """
+        Adds <count> to download count of download with <download_id>. Change
+        is written to database later.
+        """
+        self.increment_counts({download_id : count})
+
+    def increment_counts(self, counts):
+        """
+        Adds values of <counts> dictionary to download counts of downloads
+        with IDs of its keys. Changes are written to database later.
+        """
+        self.lock.acquire()
+        try:
+            for download_id, count in counts.items():
+                self.pending[download_id] = self.pending.get(download_id, 0) + count
+                self.pending_total += count
+            full = self.pending_total >= self.flush_size
+        finally:
+            self.lock.release()
+        if self.flusher.stopped:
+            # Interpreter exits, write counts right away.
+            self.flush()
+        elif full:
+            self.flusher.wake()
+        else:
+            self.flusher.start()
+
+    def get_pending_count(self, download_id):
+        """
+        Returns number of downloads of download with <download_id> which are
+        not written to database yet.
+        """
+        self.lock.acquire()
+        try:
+            return self.pending.get(download_id, 0) + self.flushing.get(
+              download_id, 0)
+        finally:
+            self.lock.release()
+
+    def get_pending_counts(self):
+        """
+        Returns dictionary of download IDs and their download counts which are
+        not written to database yet.
+        """
+        self.lock.acquire()
+        try:
+            counts = dict(self.pending)
+            for download_id, count in self.flushing.items():
+                counts[download_id] = counts.get(download_id, 0) + count
+            return counts
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Writes collected download counts to database in one transaction.
+        Counts being written are still reported as pending until the
+        transaction is committed and caches of stored counts are outdated.
+        """
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = {}
+            self.pending_total = 0
+            self._add_counts(self.flushing, pending, 1)
+        finally:
+            self.lock.release()
+        if not pending:
+            return
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        try:
+            # Increment counts atomically in database so no concurrent
+            # increment is lost.
+            sql = "UPDATE download SET count = COALESCE(count, 0) + %s WHERE id = %s"
+            self.log.debug("%s, %s", sql, pending)
+            for download_id, count in pending.items():
+                cursor.execute(sql, (count, download_id))
+            db.commit()
+
+            # Let caches of rendered counts know they are outdated at the
+            # same time as written counts stop being pending.
+            self.lock.acquire()
+            try:
+                self._add_counts(self.flushing, pending, -1)
+                self.generation += 1
+            finally:
+                self.lock.release()
+        except:
+            self.log.exception("Cannot update download counts, will retry later.")
+            try:
+                db.rollback()
+            except:
+                pass
+            # Return counts back to be written by next flush.
+            self.lock.acquire()
+            try:
+                self._add_counts(self.flushing, pending, -1)
+                for download_id, count in pending.items():
+                    self.pending[download_id] = self.pending.get(download_id, 0) + count
+                    self.pending_total += count
+            finally:
+                self.lock.release()
+        finally:
+            cursor.close()
+            db.close()
+
+    def _add_counts(self, target, counts, sign):
+        # Adds or subtracts <counts> to or from <target> dictionary keeping
+        # only nonzero counts. Caller holds the lock.
+        for download_id, count in counts.items():
+            count = target.get(download_id, 0) + sign * count
+            if count:
+                target[download_id] = count
+            else:
+                target.pop(download_id, None)
@@ -0,0 +1,8 @@
+def do_upgrade(env, cursor):
+
+    # Add columns for MIME type and charset detected on upload.
+    cursor.execute("ALTER TABLE download ADD COLUMN mimetype text")
+    cursor.execute("ALTER TABLE download ADD COLUMN charset text")
+
+    # Set database schema version.
+    cursor.execute("UPDATE system SET value = 3 WHERE name = 'downloads_version'")
@@ -0,0 +1,25 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+# Downloads are looked up by file name, listed by upload time in timeline and
+# filtered by featured flag. Only columns used by indices are defined.
+table = Table('download', key = 'id')[
+  Column('id', type = 'integer', auto_increment = True),
+  Column('file'),
+  Column('time', type = 'integer'),
+  Column('featured', type = 'tinyint'),
+  Index(['file']),
+  Index(['time']),
+  Index(['featured'])
+]
+
+def do_upgrade(env, cursor):
+    db_connector, _ = DatabaseManager(env)._get_connector()
+
+    # Create indices, table itself already exists. Database connector takes
+    # care of backend specific syntax, e.g. index prefix length on MySQL.
+    for statement in db_connector.to_sql(table):
+        if ' INDEX ' in statement.upper():
+            cursor.execute(statement)
+
+    # Set database schema version.
+    cursor.execute("UPDATE system SET value = 4 WHERE name = 'downloads_version'")
@@ -0,0 +1,8 @@
+def do_upgrade(env, cursor):
+
+    # Add columns for checksums computed on upload.
+    cursor.execute("ALTER TABLE download ADD COLUMN sha256 text")
+    cursor.execute("ALTER TABLE download ADD COLUMN md5 text")
+
+    # Set database schema version.
+    cursor.execute("UPDATE system SET value = 5 WHERE name = 'downloads_version'")
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+from datetime import datetime
+from threading import Lock
+
+# Trac imports.
+from trac.util.datefmt import utc
+
+# Local imports.
+from batch import Flusher
+
+class DownloadEvent(object):
+    """
+    Download of file by user at UTC <time>. Event doesn't refer to request,
+    so it can be processed after the request is finished.
+    """
+    def __init__(self, download, authname, time = None):
+        self.download = download
+        self.authname = authname
+        self.time = time or datetime.now(utc)
+
+class DownloadDispatcher(object):
+    """
+    Delivers download events to download listeners with downloaded_batch
+    method. Events are queued by request threads and delivered in batches
+    from background thread, each listener gets all events of a batch in one
+    call. Queued events are lost if the process is killed before they are
+    delivered.
+    """
+    def __init__(self, get_listeners, log, interval = 1, size = 100):
+        self.get_listeners = get_listeners
+        self.log = log
+        self.size = size
+        self.events = []
+        self.lock = Lock()
+        self.flusher = Flusher('DownloadDispatcher', self.flush, log, interval)
+
+    def dispatch(self, event):
+        """
+        Queues <event> to be delivered from background thread.
+        """
+        self.lock.acquire()
+        try:
+            self.events.append(event)
+            full = len(self.events) >= self.size
+        finally:
+            self.lock.release()
+        if self.flusher.stopped:
+            # Interpreter exits, deliver event right away.
+            self.flush()
+        elif full:
+            self.flusher.wake()
+        else:
+            self.flusher.start()
+
+    def flush(self):
+        """
+        Delivers all queued events.
+        """
+        self.lock.acquire()
+        try:
+            events = self.events
+            self.events = []
+        finally:
+            self.lock.release()
+        if events:
+            self.deliver(events)
+
+    def deliver(self, events):
+        """
+        Delivers <events> to listeners with batch support. Failure of one
+        listener doesn't affect the others.
+        """
+        for listener in self.get_listeners():
+            if not hasattr(listener, 'downloaded_batch'):
+                continue
+            try:
+                listener.downloaded_batch(events)
+            except Exception:
+                self.log.exception("Download listener %s failed",
+                  listener.__class__.__name__)
@@ -5,7 +5,7 @@ from trac.env import IEnvironmentSetupParticipant
 
 
 # Last screenshots database shcema version
-last_db_version = 2
+last_db_version = 5
 
 class DownloadsInit(Component):
     """
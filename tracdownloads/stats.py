@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import os, re, time, glob, errno, tempfile
+from threading import Lock, local
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Prefix of files with saved statistics of server processes.
+file_prefix = 'downloads-stats-'
+
+# Name of file with merged statistics of processes which don't run anymore.
+archive_name = 'archive'
+
+# Number of slow queries kept in archived statistics.
+max_archived_slow_queries = 50
+
+class QueryStats(object):
+    """
+    Thread safe collector of database query statistics. Queries are counted
+    per request of current thread and summarized per page when the request
+    finishes. Slow queries are kept in a bounded list.
+    """
+    def __init__(self, max_pages = 500, max_slow_queries = 50):
+        self.max_pages = max_pages
+        self.max_slow_queries = max_slow_queries
+        self.local = local()
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all collected statistics.
+        """
+        self.lock.acquire()
+        try:
+            self.started = time.time()
+            self.pages = {}
+            self.slow_queries = []
+        finally:
+            self.lock.release()
+
+    def start_request(self, path):
+        """
+        Starts counting queries of request for <path> in current thread.
+        Request which was not finished properly, for example because file
+        transfer ended it with RequestDone, is finished first.
+        """
+        self.finish_request()
+        self.local.request = {'page' : get_page(path), 'queries' : 0,
+          'time' : 0.0, 'rows' : 0}
+
+    def record(self, sql, duration, rows, slow = False):
+        """
+        Records query <sql> which took <duration> seconds and returned <rows>
+        rows.
+        """
+        request = getattr(self.local, 'request', None)
+        if request:
+            request['queries'] += 1
+            request['time'] += duration
+            request['rows'] += rows
+        if slow:
+            self.lock.acquire()
+            try:
+                self.slow_queries.append({'sql' : sql, 'time' : duration,
+                  'rows' : rows, 'page' : request and request['page'],
+                  'when' : time.time()})
+                del self.slow_queries[:-self.max_slow_queries]
+            finally:
+                self.lock.release()
+
+    def get_request_stats(self):
+        """
+        Returns dictionary with query count, time and rows of current request
+        or None if no request is counted in current thread.
+        """
+        request = getattr(self.local, 'request', None)
+        return request and dict(request)
+
+    def finish_request(self):
+        """
+        Adds statistics of current request to statistics of its page and
+        returns them. Requests without queries are not recorded.
+        """
+        request = getattr(self.local, 'request', None)
+        self.local.request = None
+        if not request or not request['queries']:
+            return request
+        self.lock.acquire()
+        try:
+            page = self.pages.get(request['page'])
+            if not page:
+                if len(self.pages) >= self.max_pages:
+                    request['page'] = '(other)'
+                page = self.pages.setdefault(request['page'], {'page' :
+                  request['page'], 'requests' : 0, 'queries' : 0, 'time' : 0.0,
+                  'rows' : 0, 'max_queries' : 0})
+            page['requests'] += 1
+            page['queries'] += request['queries']
+            page['time'] += request['time']
+            page['rows'] += request['rows']
+            page['max_queries'] = max(page['max_queries'], request['queries'])
+        finally:
+            self.lock.release()
+        return request
+
+    def to_dict(self):
+        """
+        Returns copy of all collected statistics.
+        """
+        self.lock.acquire()
+        try:
+            return {'started' : self.started,
+                    'pages' : [dict(page) for page in self.pages.values()],
+                    'slow_queries' : [dict(query) for query in self.slow_queries]}
+        finally:
+            self.lock.release()
+
+    def save(self, directory):
+        """
+        Writes statistics of this process to JSON file in <directory>.
+        """
+        data = self.to_dict()
+        if not data['pages'] and not data['slow_queries']:
+            return
+        write_stats(directory, os.getpid(), data)
+
+def get_page(path):
+    """
+    Returns name of page under which request for <path> is counted. Numeric
+    path segments, like download IDs, are replaced by asterisk.
+    """
+    return re.sub(r'/\d+(?=/|$)', '/*', path or '/')
+
+def write_stats(directory, name, data):
+    """
+    Atomically writes statistics <data> to JSON file with <name> suffix in
+    <directory>.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    handle, temp_path = tempfile.mkstemp(dir = directory)
+    file = os.fdopen(handle, 'w')
+    try:
+        json.dump(data, file)
+    finally:
+        file.close()
+    os.rename(temp_path, os.path.join(directory, '%s%s.json' % (file_prefix,
+      name)))
+
+def is_running(pid):
+    """
+    Returns True if process with <pid> runs or its state can't be checked.
+    """
+    if not hasattr(os, 'kill'):
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        return error.errno != errno.ESRCH
+    return True
+
+def merge_stats(stats, data):
+    """
+    Adds statistics <data> saved by a process to merged <stats>.
+    """
+    if data['started']:
+        stats['started'] = min(stats['started'] or data['started'],
+          data['started'])
+    for page in data['pages']:
+        merged = stats['pages'].setdefault(page['page'], {'page' : page['page'],
+          'requests' : 0, 'queries' : 0, 'time' : 0.0, 'rows' : 0,
+          'max_queries' : 0})
+        for key in ('requests', 'queries', 'time', 'rows'):
+            merged[key] += page[key]
+        merged['max_queries'] = max(merged['max_queries'], page['max_queries'])
+    stats['slow_queries'] += data['slow_queries']
+
+def load_stats(directory):
+    """
+    Merges statistics saved by all processes to <directory>. Statistics of
+    processes which don't run anymore are moved to one archive file, so
+    number of files doesn't grow with each restarted process.
+    """
+    stats = {'started' : None, 'pages' : {}, 'slow_queries' : []}
+    archive = {'started' : None, 'pages' : {}, 'slow_queries' : []}
+    finished_paths = []
+    for path in glob.glob(os.path.join(directory, file_prefix + '*.json')):
+        name = os.path.basename(path)[len(file_prefix):-len('.json')]
+        try:
+            file = open(path)
+            try:
+                data = json.load(file)
+            finally:
+                file.close()
+        except (IOError, ValueError):
+            # File was archived meanwhile or is damaged.
+            continue
+        merge_stats(stats, data)
+        if name == archive_name:
+            merge_stats(archive, data)
+        elif name.isdigit() and not is_running(int(name)):
+            merge_stats(archive, data)
+            finished_paths.append(path)
+
+    # Archive is written before statistics of finished processes are removed,
+    # so they are never lost.
+    if finished_paths:
+        archive['slow_queries'].sort(key = lambda query: query['when'])
+        del archive['slow_queries'][:-max_archived_slow_queries]
+        write_stats(directory, archive_name, {'started' : archive['started'],
+          'pages' : archive['pages'].values(), 'slow_queries' :
+          archive['slow_queries']})
+        for path in finished_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    stats['slow_queries'].sort(key = lambda query: query['when'])
+    return {'started' : stats['started'], 'pages' : stats['pages'].values(),
+      'slow_queries' : stats['slow_queries']}
+
+def remove_stats(directory):
+    """
+    Removes statistics saved by all processes to <directory> including the
+    archive.
+    """
+    for path in glob.glob(os.path.join(directory, file_prefix + '*.json')):
+        os.remove(path)
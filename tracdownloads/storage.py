@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import os, errno, shutil, hashlib, binascii
+from threading import Lock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Trac imports.
+from trac.core import Component, implements
+from trac.config import BoolOption
+from trac.util.text import to_unicode
+
+#cqde imports
+from multiproject.core.configuration import conf
+from multiproject.core.db import safe_int
+
+# Local imports.
+from api import IDownloadStorage
+import transfer
+
+# Serializes creation and removal of blobs shared by downloads between
+# threads, other processes are excluded by lock file in .blobs directory.
+blob_lock = Lock()
+
+class LocalDownloadsStorage(Component):
+    """
+        The local storage keeps download files in downloads directory of the
+        project, each in subdirectory named by download ID.
+    """
+    implements(IDownloadStorage)
+
+    # Configuration options.
+    dedupe = BoolOption('downloads', 'dedupe', False,
+      doc = 'If enabled stores files with identical content only once. Download files are'
+      ' hardlinks to content-addressed blobs in .blobs subdirectory of downloads directory.')
+
+    def __init__(self):
+        self.path = conf.getEnvironmentDownloadsPath(self.env)
+
+    # IDownloadStorage methods.
+
+    def put(self, download, temp_path, old_download = None):
+        path = self.get_directory(download)
+        filepath = self.get_file_path(download)
+        created = not os.path.exists(path.encode('utf-8'))
+        try:
+            if created:
+                os.makedirs(path.encode('utf-8'))
+            self._store_file(temp_path, filepath, download.get('sha256'))
+        except:
+            if created:
+                self._remove_directories(path)
+            raise
+
+        # Remove old file, if it was replaced by file with different name.
+        if old_download:
+            old_filepath = self.get_file_path(old_download)
+            if old_filepath != filepath:
+                try:
+                    os.remove(old_filepath.encode('utf-8'))
+                except OSError, error:
+                    self.log.exception("Error deleting old file %s, filename was '%s'",
+                      old_download['id'], old_download['file'])
+
+            # Old file could be the last reference to its blob.
+            if old_download.get('sha256') != download.get('sha256'):
+                self._release_blob(old_download.get('sha256'))
+
+    def open(self, download):
+        return open(self.get_file_path(download).encode('utf-8'), 'rb')
+
+    def stat(self, download):
+        return os.stat(self.get_file_path(download).encode('utf-8'))
+
+    def delete(self, download):
+        os.remove(self.get_file_path(download).encode('utf-8'))
+        self._remove_directories(self.get_directory(download))
+        self._release_blob(download.get('sha256'))
+
+    def get_offload_header(self, download, mode, prefix):
+        return transfer.get_offload_header(mode, self.get_file_path(download),
+          self.path, prefix)
+
+    # Public methods.
+
+    def get_directory(self, download):
+        """
+        Returns path of directory with stored file of <download>.
+        """
+        return os.path.normpath(os.path.join(self.path,
+          to_unicode(safe_int(download['id']))))
+
+    def get_file_path(self, download):
+        """
+        Returns path of stored file of <download>.
+        """
+        return os.path.join(self.get_directory(download),
+          os.path.basename(download['file']))
+
+    def get_blob_path(self, sha256):
+        """
+        Returns path of content-addressed blob with <sha256> checksum.
+        """
+        return os.path.join(self.path, '.blobs', sha256[:2], sha256)
+
+    def dedupe_file(self, download):
+        """
+        Replaces stored file of <download> with hardlink to blob of its
+        content. Returns number of bytes freed by sharing existing blob.
+        """
+        filepath = self.get_file_path(download)
+        blob_path = self.get_blob_path(download['sha256']).encode('utf-8')
+        if os.path.exists(blob_path) and os.path.samefile(blob_path,
+          filepath.encode('utf-8')):
+            return 0
+        freed = os.path.exists(blob_path) and download['size'] or 0
+
+        # Current file is linked to temporary name which becomes the blob if
+        # it doesn't exist yet.
+        incoming_path = os.path.join(self.path, '.incoming').encode('utf-8')
+        self._make_directory(incoming_path)
+        temp_path = self._link_unique(filepath.encode('utf-8'), incoming_path)
+        try:
+            self._store_file(temp_path, filepath, download['sha256'])
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return freed
+
+    # Internal methods.
+
+    def _store_file(self, temp_path, filepath, sha256):
+        """
+        Moves file from <temp_path> to <filepath>. If deduplication is enabled
+        <filepath> becomes hardlink to blob with <sha256> checksum, which is
+        created from the file only if no other download has the same content.
+        Blobs are reference-counted by their number of links.
+        """
+        filepath = filepath.encode('utf-8')
+        if not self.dedupe or not sha256 or not hasattr(os, 'link'):
+            os.rename(temp_path, filepath)
+            return
+        blob_path = self.get_blob_path(sha256).encode('utf-8')
+        link_path = temp_path + '.link'
+        lock_file = self._lock_blobs()
+        try:
+            created = not os.path.exists(blob_path)
+            if created:
+                self._make_directory(os.path.dirname(blob_path))
+                os.rename(temp_path, blob_path)
+            # Link is created next to temporary file and renamed so existing
+            # file with the same name is replaced atomically.
+            try:
+                os.link(blob_path, link_path)
+                os.rename(link_path, filepath)
+                # Rename does nothing if file already was link to the blob.
+                if os.path.exists(link_path):
+                    os.remove(link_path)
+            except OSError, error:
+                if os.path.exists(link_path):
+                    os.remove(link_path)
+                if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                # File system can't link the blob, store a plain file.
+                self.log.warning("Cannot link blob %s, storing plain file: %s",
+                  sha256, to_unicode(error))
+                if created:
+                    os.rename(blob_path, filepath)
+                else:
+                    shutil.copyfile(blob_path, filepath)
+        finally:
+            self._unlock_blobs(lock_file)
+
+    def _release_blob(self, sha256):
+        """
+        Removes blob with <sha256> checksum if no download file links to it
+        anymore.
+        """
+        if not sha256:
+            return
+        blob_path = self.get_blob_path(sha256).encode('utf-8')
+        try:
+            lock_file = self._lock_blobs()
+        except (IOError, OSError), error:
+            self.log.exception("Cannot lock blobs to release blob %s", sha256)
+            return
+        try:
+            try:
+                if os.stat(blob_path).st_nlink <= 1:
+                    os.remove(blob_path)
+            except OSError, error:
+                if error.errno != errno.ENOENT:
+                    self.log.exception("Cannot release blob %s", sha256)
+        finally:
+            self._unlock_blobs(lock_file)
+
+    def _lock_blobs(self):
+        """
+        Acquires exclusive access to blobs for current thread and process.
+        Returns opened lock file which has to be passed to _unlock_blobs().
+        """
+        blob_lock.acquire()
+        if not fcntl:
+            return None
+        try:
+            blobs_path = os.path.join(self.path, '.blobs').encode('utf-8')
+            self._make_directory(blobs_path)
+            lock_file = open(os.path.join(blobs_path, '.lock'), 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            except:
+                lock_file.close()
+                raise
+            return lock_file
+        except:
+            blob_lock.release()
+            raise
+
+    def _unlock_blobs(self, lock_file):
+        # Closing the lock file releases its lock.
+        try:
+            if lock_file:
+                lock_file.close()
+        finally:
+            blob_lock.release()
+
+    def _link_unique(self, path, directory):
+        """
+        Creates hardlink to file with <path> under unique name in <directory>
+        and returns its path. Link creation fails if the name exists, so the
+        name can't be taken by other process meanwhile.
+        """
+        while True:
+            link_path = os.path.join(directory, 'tmp' + binascii.hexlify(
+              os.urandom(8)))
+            try:
+                os.link(path, link_path)
+                return link_path
+            except OSError, error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    def _make_directory(self, path):
+        # Creates directory <path> unless it exists or is created by
+        # concurrent request.
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError, error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    def _remove_directories(self, path):
+        # Removes directory <path> and its parents up to downloads directory
+        # while they are empty.
+        root = os.path.normpath(self.path)
+        while path != root and path.startswith(root + os.sep):
+            try:
+                os.rmdir(path.encode('utf-8'))
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
+class ShardedDownloadsStorage(LocalDownloadsStorage):
+    """
+        The sharded storage spreads download subdirectories over two levels of
+        directories named by hash of download ID, so no directory contains
+        more than a few hundred entries.
+    """
+
+    # Public methods.
+
+    def get_directory(self, download):
+        download_id = to_unicode(safe_int(download['id']))
+        digest = hashlib.md5(download_id.encode('utf-8')).hexdigest()
+        return os.path.normpath(os.path.join(self.path, 'sharded', digest[:2],
+          digest[2:4], download_id))
@@ -5,12 +5,16 @@ from trac.core import Component, implements
 from trac.resource import Resource
 from trac.mimeview import Context
 from trac.config import ListOption
+from trac.admin import IAdminCommandProvider, AdminCommandError
+from trac.util.translation import _
+from trac.util.text import printout
 
 # TagsPlugin imports.
 from tractags.api import DefaultTagProvider, TagSystem #@UnresolvedImport
 
 # Local imports.
-from api import DownloadsApi, IDownloadChangeListener
+from api import DownloadsApi, IDownloadChangeListener, database_context
+from consoleadmin import DownloadsConsoleAdmin, FakeRequest
 
 class DownloadsTagProvider(DefaultTagProvider):
     """
@@ -33,10 +37,14 @@ class DownloadsTags(Component):
         The tags module implements plugin's ability to create tags related
         to downloads.
     """
-    implements(IDownloadChangeListener)
+    implements(IDownloadChangeListener, IAdminCommandProvider)
 
     realm = 'downloads'
 
+    # Download attributes which generate tags.
+    tag_attributes = ('author', 'component', 'version', 'platform', 'type',
+      'tags')
+
     # Configuration options.
 
     additional_tags = ListOption('downloads', 'additional_tags',
@@ -51,17 +59,11 @@ class DownloadsTags(Component):
         if not context.req.perm.has_permission('TAGS_MODIFY'):
             return
 
-        # Create temporary resource.
-        resource = Resource(self.realm, download['id'])
-
-        # Delete tags of download with same ID for sure.
-        tag_system = TagSystem(self.env)
-        tag_system.delete_tags(context.req, resource)
-
-        # Add tags of new download.
-        new_tags = self._get_tags(download)
+        # Tags of download with same ID could be left, replace them.
+        new_tags = self._get_tags(context, download)
         self.log.debug('tags: %s' % (new_tags,))
-        tag_system.add_tags(context.req, resource, new_tags)
+        self._sync_tags(context.req, Resource(self.realm, download['id']),
+          new_tags)
 
     def download_changed(self, context, download, old_download):
         # Check proper permissions to modify tags.
@@ -72,19 +74,16 @@ class DownloadsTags(Component):
         if not self._has_tags_changed(download):
             return
 
-        # Update old download with new values.
-        old_download.update(download)
-
-        # Create temporary resource.
-        resource = Resource(self.realm, old_download['id'])
-
-        # Delete old tags.
-        tag_system = TagSystem(self.env)
-        tag_system.delete_tags(context.req, resource)
-
-        # Add new ones.
-        new_tags = self._get_tags(old_download)
-        tag_system.add_tags(context.req, resource, new_tags)
+        # Compare tags of old download with tags of old download updated
+        # with new values, changes are applied only if they differ.
+        new_download = dict(old_download)
+        new_download.update(download)
+        old_tags = self._get_tags(context, old_download)
+        new_tags = self._get_tags(context, new_download)
+        if set(old_tags) == set(new_tags):
+            return
+        self._sync_tags(context.req, Resource(self.realm, old_download['id']),
+          new_tags)
 
     def download_deleted(self, context, download):
         # Check proper permissions to modify tags.
@@ -98,49 +97,129 @@ class DownloadsTags(Component):
         tag_system = TagSystem(self.env)
         tag_system.delete_tags(context.req, resource)
 
+    # IAdminCommandProvider methods.
+
+    def get_admin_commands(self):
+        yield ('download retag', '',
+          'Rebuild tags of all downloads from their attributes', None,
+          self._do_retag)
+
     # Private methods
 
+    def _do_retag(self):
+        # Get downloads API component.
+        api = self.env[DownloadsApi]
+
+        # Create context.
+        context = Context('downloads-consoleadmin')
+        context.req = FakeRequest(self.env,
+          self.env[DownloadsConsoleAdmin].consoleadmin_user)
+        if not context.req.perm.has_permission('TAGS_MODIFY'):
+            raise AdminCommandError(_('User %(user)s set by [downloads]'
+              ' consoleadmin_user option has no TAGS_MODIFY permission.',
+              user = self.env[DownloadsConsoleAdmin].consoleadmin_user))
+
+        with database_context(self.env, context):
+            downloads = api.get_downloads(context)
+            platforms, types = self._get_names(context)
+
+        # Read current tags of all downloads at once.
+        tag_system = TagSystem(self.env)
+        stored_tags = {}
+        for resource, tags in tag_system.query(context.req, 'realm:%s' %
+          (self.realm,)):
+            stored_tags[resource.id] = set(tags)
+
+        # Apply only differences between stored and current tags.
+        added = removed = changed = 0
+        for download in downloads:
+            resource = Resource(self.realm, download['id'])
+            old_tags = stored_tags.pop(unicode(download['id']), set())
+            new_tags = self._get_tags(context, download, platforms, types)
+            counts = self._apply_tags(tag_system, context.req, resource,
+              old_tags, new_tags)
+            added += counts[0]
+            removed += counts[1]
+            changed += int(counts != (0, 0))
+
+        # Remove tags of downloads which don't exist anymore.
+        for download_id, old_tags in stored_tags.items():
+            if not old_tags:
+                continue
+            resource = Resource(self.realm, download_id)
+            removed += self._apply_tags(tag_system, context.req, resource,
+              old_tags, [])[1]
+            changed += 1
+
+        printout(_('Tags of %(changed)s downloads updated, %(added)s tags'
+          ' added, %(removed)s tags removed.', changed = changed,
+          added = added, removed = removed))
+
+    def _sync_tags(self, req, resource, tags):
+        # Replaces stored tags of <resource> with <tags>.
+        tag_system = TagSystem(self.env)
+        old_tags = set(tag_system.get_tags(req, resource))
+        self._apply_tags(tag_system, req, resource, old_tags, tags)
+
+    def _apply_tags(self, tag_system, req, resource, old_tags, tags):
+        # Deletes and adds only tags which differ between <old_tags> and
+        # <tags>. Returns numbers of added and removed tags.
+        new_tags = set(tags)
+        removed = old_tags - new_tags
+        added = new_tags - old_tags
+        if removed:
+            tag_system.delete_tags(req, resource, removed)
+        if added:
+            tag_system.add_tags(req, resource, added)
+        return len(added), len(removed)
+
     def _has_tags_changed(self, download):
         # Return True if there is any attribute that generate tags in download.
-        return download.has_key('author') or download.has_key('component') or download.has_key('version') or \
-          download.has_key('platform') or download.has_key('type') or download.has_key('tags')
+        for name in self.tag_attributes:
+            if download.has_key(name):
+                return True
+        return False
 
-    def _get_tags(self, download):
+    def _get_tags(self, context, download, platforms = None, types = None):
         # Translate platform and type ID to its names.
-        self._resolve_ids(download)
+        if platforms is None or types is None:
+            platforms, types = self._get_names(context)
+        platform = self._get_name(download.get('platform'), platforms)
+        type = self._get_name(download.get('type'), types)
 
         # Prepare tag names.
-        self.log.debug("additional_tags: %s" % (self.additional_tags,))
         tags = []
-        if 'author' in self.additional_tags and download['author']:
+        if 'author' in self.additional_tags and download.get('author'):
             tags += [download['author']]
-        if 'component' in self.additional_tags and download['component']:
+        if 'component' in self.additional_tags and download.get('component'):
             tags += [download['component']]
-        if 'version' in self.additional_tags and download['version']:
+        if 'version' in self.additional_tags and download.get('version'):
             tags += [download['version']]
-        if 'platform' in self.additional_tags and download['platform']:
-            tags += [download['platform']]
-        if 'type' in self.additional_tags and download['type']:
-            tags += [download['type']]
-        if download['tags']:
+        if 'platform' in self.additional_tags and platform:
+            tags += [platform]
+        if 'type' in self.additional_tags and type:
+            tags += [type]
+        if download.get('tags'):
             tags += download['tags'].split()
         return sorted(tags)
 
-    def _get_stored_tags(self, context, download_id):
-        tag_system = TagSystem(self.env)
-        resource = Resource(self.realm, download_id)
-        tags = tag_system.get_tags(context.req, resource)
-        return sorted(tags)
-
-    def _resolve_ids(self, download):
-        # Create context.
-        context = Context('downloads-core')
-        db = self.env.get_db_cnx()
-        context.cursor = db.cursor()
-
-        # Resolve platform and type names.
+    def _get_names(self, context):
+        # Returns maps of platform and type IDs to their names. They are read
+        # from metadata cache of DownloadsApi, database is queried only if
+        # the cache is empty.
         api = self.env[DownloadsApi]
-        platform = api.get_platform(context, download['platform'])
-        type = api.get_type(context, download['type'])
-        download['platform'] = platform['name']
-        download['type'] = type['name']
+        with database_context(self.env, context):
+            platforms = dict([(platform['id'], platform['name']) for platform
+              in api.get_platforms(context)])
+            types = dict([(type['id'], type['name']) for type in
+              api.get_types(context)])
+        return platforms, types
+
+    def _get_name(self, value, names):
+        # Platform and type is either ID or dictionary from joined query.
+        if isinstance(value, dict):
+            return value['name']
+        try:
+            return names.get(int(value), '')
+        except (TypeError, ValueError):
+            return ''
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from tracdownloads.tests import cache, storage, transfer
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(cache.suite())
+    suite.addTest(storage.suite())
+    suite.addTest(transfer.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest = 'suite')
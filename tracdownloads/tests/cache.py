@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import unittest
+
+# Local imports.
+from tracdownloads.cache import Cache
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = Cache(2)
+        self.calls = 0
+
+    def retriever(self, value):
+        def retrieve():
+            self.calls += 1
+            return value
+        return retrieve
+
+    def test_cached(self):
+        self.assertEqual(self.cache.get('a', self.retriever(1)), 1)
+        self.assertEqual(self.cache.get('a', self.retriever(2)), 1)
+        self.assertEqual(self.calls, 1)
+
+    def test_expired(self):
+        self.cache.get('a', self.retriever(1))
+        self.cache.items['a'] = (1, self.cache.items['a'][1] - 10)
+        self.assertEqual(self.cache.get('a', self.retriever(2), 5), 2)
+        self.assertEqual(self.cache.get('a', self.retriever(3)), 2)
+
+    def test_invalidate(self):
+        self.cache.get('a', self.retriever(1))
+        self.cache.get('b', self.retriever(1))
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.get('a', self.retriever(2)), 2)
+        self.assertEqual(self.cache.get('b', self.retriever(2)), 1)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get('b', self.retriever(3)), 3)
+
+    def test_full(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.get(key, self.retriever(key))
+        self.assertEqual(self.cache.items.keys(), ['c'])
+
+    def test_failed_retrieval(self):
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, self.cache.get, 'a', fail)
+        self.assertEqual(self.cache.get('a', self.retriever(1)), 1)
+
+    def test_invalidated_during_retrieval(self):
+        # Value read before invalidation is returned but not stored.
+        def retrieve():
+            self.cache.invalidate('a')
+            return 'old'
+        self.assertEqual(self.cache.get('a', retrieve), 'old')
+        self.assertEqual(self.cache.get('a', self.retriever('new')), 'new')
+        self.assertEqual(self.cache.get('a', self.retriever('newer')), 'new')
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CacheTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest = 'suite')
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import os, shutil, tempfile, unittest
+
+# Trac imports.
+from trac.test import EnvironmentStub
+
+# Local imports.
+from tracdownloads.storage import LocalDownloadsStorage
+
+class DedupeStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable = ['tracdownloads.*'])
+        self.env.config.set('downloads', 'dedupe', 'true')
+        self.storage = LocalDownloadsStorage(self.env)
+        self.storage.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage.path)
+        self.env.reset_db()
+
+    def temp_file(self, content):
+        incoming_path = os.path.join(self.storage.path, '.incoming')
+        if not os.path.exists(incoming_path):
+            os.makedirs(incoming_path)
+        handle, temp_path = tempfile.mkstemp(dir = incoming_path)
+        os.write(handle, content)
+        os.close(handle)
+        return temp_path
+
+    def links(self, sha256):
+        path = self.storage.get_blob_path(sha256)
+        return os.path.exists(path) and os.stat(path).st_nlink or 0
+
+    def test_shared_blob(self):
+        first = {'id' : 1, 'file' : 'a.zip', 'sha256' : 'aa11'}
+        second = {'id' : 2, 'file' : 'b.zip', 'sha256' : 'aa11'}
+        self.storage.put(first, self.temp_file('A'))
+        self.storage.put(second, self.temp_file('A'))
+        self.assertEqual(self.links('aa11'), 3)
+        self.storage.delete(first)
+        self.assertEqual(self.links('aa11'), 2)
+        self.storage.delete(second)
+        self.assertEqual(self.links('aa11'), 0)
+
+    def test_replace_file(self):
+        old_download = {'id' : 1, 'file' : 'a.zip', 'sha256' : 'aa11'}
+        other = {'id' : 2, 'file' : 'b.zip', 'sha256' : 'aa11'}
+        self.storage.put(old_download, self.temp_file('A'))
+        self.storage.put(other, self.temp_file('A'))
+
+        # Replaced file drops its link to the old blob.
+        download = {'id' : 1, 'file' : 'c.zip', 'sha256' : 'bb22'}
+        self.storage.put(download, self.temp_file('B'), old_download)
+        self.assertEqual(self.links('aa11'), 2)
+        self.assertEqual(self.links('bb22'), 2)
+        self.assertEqual(os.listdir(self.storage.get_directory(download)),
+          ['c.zip'])
+
+        # Replaced file with the same name was the last link to the blob.
+        old_download = other
+        download = {'id' : 2, 'file' : 'b.zip', 'sha256' : 'bb22'}
+        self.storage.put(download, self.temp_file('B'), old_download)
+        self.assertEqual(self.links('aa11'), 0)
+        self.assertEqual(self.links('bb22'), 3)
+        self.assertEqual(self.storage.open(download).read(), 'B')
+
+    def test_replace_last_reference(self):
+        old_download = {'id' : 1, 'file' : 'a.zip', 'sha256' : 'aa11'}
+        self.storage.put(old_download, self.temp_file('A'))
+        self.assertEqual(self.links('aa11'), 2)
+        download = {'id' : 1, 'file' : 'c.zip', 'sha256' : 'bb22'}
+        self.storage.put(download, self.temp_file('B'), old_download)
+        self.assertEqual(self.links('aa11'), 0)
+        self.assertEqual(self.links('bb22'), 2)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DedupeStorageTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest = 'suite')
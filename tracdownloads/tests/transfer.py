@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import os, unittest
+from StringIO import StringIO
+
+# Trac imports.
+from trac.util.datefmt import http_date
+
+# Local imports.
+from tracdownloads import transfer
+
+class Request(object):
+    """
+    Request stub which records sent response.
+    """
+    def __init__(self, headers = None, method = 'GET'):
+        self.headers = dict([(name.lower(), value) for name, value in
+          (headers or {}).items()])
+        self.method = method
+        self.status = None
+        self.sent_headers = {}
+        self.body = ''
+
+    def get_header(self, name):
+        return self.headers.get(name.lower())
+
+    def send_response(self, code):
+        self.status = code
+
+    def send_header(self, name, value):
+        self.sent_headers[name] = value
+
+    def end_headers(self):
+        pass
+
+    def write(self, data):
+        self.body += data
+
+download = {'id' : 7, 'size' : 10, 'time' : 1300000000}
+
+class ParseRangeTestCase(unittest.TestCase):
+    def test_missing(self):
+        self.assertEqual(transfer.parse_range(None, 10), None)
+        self.assertEqual(transfer.parse_range('', 10), None)
+
+    def test_unsupported(self):
+        self.assertEqual(transfer.parse_range('bytes=-', 10), None)
+        self.assertEqual(transfer.parse_range('bytes=0-1,3-4', 10), None)
+        self.assertEqual(transfer.parse_range('items=0-1', 10), None)
+
+    def test_closed(self):
+        self.assertEqual(transfer.parse_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(transfer.parse_range(' bytes=0-0 ', 10), (0, 0))
+
+    def test_open(self):
+        self.assertEqual(transfer.parse_range('bytes=0-', 10), (0, 9))
+        self.assertEqual(transfer.parse_range('bytes=9-', 10), (9, 9))
+
+    def test_last_beyond_end(self):
+        self.assertEqual(transfer.parse_range('bytes=5-100', 10), (5, 9))
+
+    def test_suffix(self):
+        self.assertEqual(transfer.parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(transfer.parse_range('bytes=-30', 10), (0, 9))
+
+    def test_unsatisfiable(self):
+        self.assertEqual(transfer.parse_range('bytes=10-', 10), False)
+        self.assertEqual(transfer.parse_range('bytes=5-2', 10), False)
+        self.assertEqual(transfer.parse_range('bytes=-0', 10), False)
+
+    def test_empty_file(self):
+        self.assertEqual(transfer.parse_range('bytes=0-', 0), False)
+        self.assertEqual(transfer.parse_range('bytes=-5', 0), False)
+        self.assertEqual(transfer.parse_range('bytes=0-0', 0), False)
+        self.assertEqual(transfer.parse_range(None, 0), None)
+
+class IsNotModifiedTestCase(unittest.TestCase):
+    etag = '"7-10-1300000000"'
+
+    def test_no_headers(self):
+        self.assertFalse(transfer.is_not_modified(Request(), self.etag,
+          1300000000))
+
+    def test_if_none_match(self):
+        for value in (self.etag, '"x", ' + self.etag, '*'):
+            self.assertTrue(transfer.is_not_modified(Request({'If-None-Match' :
+              value}), self.etag, 1300000000))
+        self.assertFalse(transfer.is_not_modified(Request({'If-None-Match' :
+          '"7-10-1"'}), self.etag, 1300000000))
+
+    def test_if_none_match_precedes_if_modified_since(self):
+        req = Request({'If-None-Match' : '"other"', 'If-Modified-Since' :
+          http_date(1300000000)})
+        self.assertFalse(transfer.is_not_modified(req, self.etag, 1300000000))
+
+    def test_if_modified_since(self):
+        req = Request({'If-Modified-Since' : http_date(1300000000)})
+        self.assertTrue(transfer.is_not_modified(req, self.etag, 1300000000))
+        self.assertFalse(transfer.is_not_modified(req, self.etag, 1300000001))
+
+    def test_invalid_date(self):
+        req = Request({'If-Modified-Since' : 'yesterday'})
+        self.assertFalse(transfer.is_not_modified(req, self.etag, 1300000000))
+
+class SendFileTestCase(unittest.TestCase):
+    def send(self, headers = None, method = 'GET', content = '0123456789'):
+        req = Request(headers, method)
+        status = transfer.send_file(req, StringIO(content), len(content),
+          dict(download, size = len(content)), 'application/zip')
+        self.assertEqual(status, req.status)
+        return req
+
+    def test_whole_file(self):
+        req = self.send()
+        self.assertEqual(req.status, 200)
+        self.assertEqual(req.body, '0123456789')
+        self.assertEqual(req.sent_headers['Content-Length'], 10)
+        self.assertEqual(req.sent_headers['ETag'], '"7-10-1300000000"')
+        self.assertEqual(req.sent_headers['Accept-Ranges'], 'bytes')
+
+    def test_head(self):
+        req = self.send(method = 'HEAD')
+        self.assertEqual(req.status, 200)
+        self.assertEqual(req.body, '')
+
+    def test_range(self):
+        req = self.send({'Range' : 'bytes=2-4'})
+        self.assertEqual(req.status, 206)
+        self.assertEqual(req.body, '234')
+        self.assertEqual(req.sent_headers['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(req.sent_headers['Content-Length'], 3)
+
+    def test_if_range(self):
+        req = self.send({'Range' : 'bytes=2-4', 'If-Range' : '"7-10-1300000000"'})
+        self.assertEqual(req.status, 206)
+        req = self.send({'Range' : 'bytes=2-4', 'If-Range' : http_date(1300000000)})
+        self.assertEqual(req.status, 206)
+
+    def test_if_range_outdated(self):
+        req = self.send({'Range' : 'bytes=2-4', 'If-Range' : '"7-10-1"'})
+        self.assertEqual(req.status, 200)
+        self.assertEqual(req.body, '0123456789')
+
+    def test_unsatisfiable(self):
+        req = self.send({'Range' : 'bytes=20-'})
+        self.assertEqual(req.status, 416)
+        self.assertEqual(req.sent_headers['Content-Range'], 'bytes */10')
+        self.assertEqual(req.body, '')
+
+    def test_empty_file(self):
+        req = self.send({'Range' : 'bytes=0-'}, content = '')
+        self.assertEqual(req.status, 416)
+        self.assertEqual(req.sent_headers['Content-Range'], 'bytes */0')
+
+    def test_not_modified(self):
+        req = self.send({'If-None-Match' : '"7-10-1300000000"'})
+        self.assertEqual(req.status, 304)
+        self.assertEqual(req.body, '')
+
+class OffloadTestCase(unittest.TestCase):
+    root = os.path.join(os.sep, 'srv', 'downloads')
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def test_x_sendfile(self):
+        self.assertEqual(transfer.get_offload_header('x-sendfile',
+          self.path('7', 'release.zip'), self.root, '/protected'),
+          ('X-Sendfile', self.path('7', 'release.zip')))
+
+    def test_x_accel_redirect(self):
+        self.assertEqual(transfer.get_offload_header('x-accel-redirect',
+          self.path('7', 'release.zip'), self.root, '/protected/'),
+          ('X-Accel-Redirect', '/protected/7/release.zip'))
+
+    def test_x_accel_redirect_quoting(self):
+        self.assertEqual(transfer.get_offload_header('x-accel-redirect',
+          self.path('7', u'my releaseé?.zip'), self.root,
+          u'/protected files'), ('X-Accel-Redirect',
+          '/protected%20files/7/my%20release%C3%A9%3F.zip'))
+
+    def test_disabled(self):
+        for mode in ('', None, 'x-unknown'):
+            self.assertEqual(transfer.get_offload_header(mode,
+              self.path('7', 'release.zip'), self.root, '/protected'), None)
+
+    def test_outside_root(self):
+        for path in (self.path('..', 'secret.zip'), self.root + '-other' +
+          os.sep + 'release.zip', self.root):
+            self.assertEqual(transfer.get_offload_header('x-sendfile', path,
+              self.root, '/protected'), None)
+
+    def offload(self, headers = None):
+        req = Request(headers)
+        status = transfer.offload_file(req, ('X-Sendfile', '/srv/f.zip'),
+          download, 'application/zip')
+        return req, status
+
+    def test_offload_file(self):
+        req, status = self.offload()
+        self.assertEqual(status, 200)
+        self.assertEqual(req.status, 200)
+        self.assertEqual(req.sent_headers['X-Sendfile'], '/srv/f.zip')
+        self.assertEqual(req.sent_headers['Content-Type'], 'application/zip')
+        self.assertEqual(req.sent_headers['ETag'], '"7-10-1300000000"')
+        self.assertEqual(req.body, '')
+
+    def test_offload_not_modified(self):
+        req, status = self.offload({'If-None-Match' : '"7-10-1300000000"'})
+        self.assertEqual(status, 304)
+        self.assertFalse('X-Sendfile' in req.sent_headers)
+
+    def test_offload_range(self):
+        # Front-end server applies the range, returned status reflects it.
+        req, status = self.offload({'Range' : 'bytes=5-'})
+        self.assertEqual(status, 206)
+        self.assertEqual(req.sent_headers['X-Sendfile'], '/srv/f.zip')
+        req, status = self.offload({'Range' : 'bytes=20-'})
+        self.assertEqual(status, 416)
+        req, status = self.offload({'Range' : 'bytes=5-', 'If-Range' :
+          '"7-10-1"'})
+        self.assertEqual(status, 200)
+
+class IsNewDownloadTestCase(unittest.TestCase):
+    def test_whole_file(self):
+        self.assertTrue(transfer.is_new_download(Request(), 200))
+
+    def test_range(self):
+        self.assertTrue(transfer.is_new_download(Request({'Range' :
+          'bytes=0-99'}), 206))
+        self.assertFalse(transfer.is_new_download(Request({'Range' :
+          'bytes=100-'}), 206))
+
+    def test_head(self):
+        self.assertFalse(transfer.is_new_download(Request(method = 'HEAD'),
+          200))
+        self.assertFalse(transfer.is_new_download(Request({'Range' :
+          'bytes=0-99'}, 'HEAD'), 206))
+
+    def test_not_transferred(self):
+        for status in (304, 416):
+            self.assertFalse(transfer.is_new_download(Request(), status))
+
+    def test_resumed_offloaded_transfer(self):
+        req = Request({'Range' : 'bytes=100-'})
+        self.assertFalse(transfer.is_new_download(req,
+          transfer.offload_file(req, ('X-Sendfile', '/srv/f.zip'),
+          dict(download, size = 1000), 'application/zip')))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ParseRangeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(IsNotModifiedTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SendFileTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(OffloadTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(IsNewDownloadTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest = 'suite')
@@ -3,10 +3,11 @@
 from genshi.builder import tag
 from trac.core import Component, implements
 from trac.mimeview import Context
-from trac.resource import Resource, get_resource_url, get_resource_name, get_resource_description
+from trac.resource import Resource, get_resource_url
 from trac.util.datefmt import to_timestamp
+from trac.util.text import pretty_size
 from trac.timeline import ITimelineEventProvider
-from api import DownloadsApi
+from api import DownloadsApi, database_context
 
 class DownloadsTimeline(Component):
     """
@@ -15,6 +16,9 @@ class DownloadsTimeline(Component):
     """
     implements(ITimelineEventProvider)
 
+    # Columns needed to render timeline events.
+    event_columns = ('id', 'time', 'author', 'file', 'size', 'description')
+
     # ITimelineEventProvider
 
     def get_timeline_filters(self, req):
@@ -23,23 +27,27 @@ class DownloadsTimeline(Component):
 
     def get_timeline_events(self, req, start, stop, filters):
         if ('downloads' in filters) and ('DOWNLOADS_VIEW' in req.perm):
+            # Get API component, it may be disabled.
+            api = self.env[DownloadsApi]
+            if not api:
+                return
+
             # Create context.
             context = Context.from_request(req)('downloads-timeline')
-            db = self.env.get_db_cnx()
-            context.cursor = db.cursor()
-            try:
-                # Get API component.
-                api = self.env[DownloadsApi]
-                # Get message events
-                for download in api.get_new_downloads(context, to_timestamp(start), to_timestamp(stop)):
-                    yield ('newdownload', download['time'], download['author'], download['id'])
-            except:
-                # API maybe disabled or tables are not updated to db 
-                pass
+            with database_context(self.env, context):
+                downloads = api.get_new_downloads(context, to_timestamp(start),
+                  to_timestamp(stop), columns = self.event_columns)
+
+            # Get message events. Event data contain everything needed to
+            # render the event.
+            for download in downloads:
+                yield ('newdownload', download['time'], download['author'],
+                  (download['id'], download['file'], download['size'],
+                  download['description']))
 
     def render_timeline_event(self, context, field, event):
         # Decompose event data.
-        id = event[3]
+        id, file, size, description = event[3]
         # Return apropriate content.
         resource = Resource('downloads', id)
         if field == 'url':
@@ -48,6 +56,6 @@ class DownloadsTimeline(Component):
             else:
                 return '#'
         elif field == 'title':
-            return tag('New download ', tag.em(get_resource_name(self.env, resource)), ' created')
+            return tag('New download ', tag.em(file), ' created')
         elif field == 'description':
-            return get_resource_description(self.env, resource, 'summary')
+            return '(%s) %s' % (pretty_size(size), description)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+# Standard imports.
+import os, re
+from email.utils import parsedate_tz, mktime_tz
+from urllib import quote
+
+# Trac imports.
+from trac.util.datefmt import http_date
+
+# Size of blocks in which file is sent to client.
+chunk_size = 64 * 1024
+
+# Supported modes of file transfer offload to front-end server.
+offload_modes = ('x-sendfile', 'x-accel-redirect')
+
+def get_etag(download):
+    """
+    Returns strong entity tag of <download>. Stored files never change, so
+    ID, size and upload time identify content of the file.
+    """
+    return '"%s-%s-%s"' % (download['id'], download['size'], download['time'])
+
+def parse_range(header, size):
+    """
+    Parses value of HTTP Range <header> of file with <size> bytes. Returns
+    tuple with first and last byte offset, None if header is missing or not
+    supported and False if the range is not satisfiable. Only single byte
+    ranges are supported, clients will get whole file otherwise. No range
+    of empty file is satisfiable.
+    """
+    match = re.match(r'''^bytes=(\d*)-(\d*)$''', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    if size <= 0:
+        return False
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        last = size - 1
+        if match.group(2):
+            last = min(int(match.group(2)), last)
+        if first > last:
+            return False
+    else:
+        # Suffix range contains last N bytes.
+        length = int(last)
+        if not length:
+            return False
+        first = max(size - length, 0)
+        last = size - 1
+    return first, last
+
+def is_not_modified(req, etag, time):
+    """
+    Returns True if client's cached copy is still valid according to its
+    If-None-Match or If-Modified-Since headers.
+    """
+    if_none_match = req.get_header('If-None-Match')
+    if if_none_match:
+        etags = [value.strip() for value in if_none_match.split(',')]
+        return '*' in etags or etag in etags
+    if_modified_since = req.get_header('If-Modified-Since')
+    if if_modified_since:
+        parsed = parsedate_tz(if_modified_since)
+        if parsed:
+            return time <= mktime_tz(parsed)
+    return False
+
+def get_range(req, size, etag, last_modified):
+    """
+    Returns byte range of file with <size> bytes requested by client as
+    parse_range() does. Range is honoured only if client's partial copy is
+    current according to its If-Range header.
+    """
+    if_range = req.get_header('If-Range')
+    if if_range and if_range not in (etag, last_modified):
+        return None
+    return parse_range(req.get_header('Range'), size)
+
+def is_new_download(req, status):
+    """
+    Returns True if response with HTTP <status> transfers file to client
+    from its beginning. Resumed transfers, cache revalidations and HEAD
+    requests are not new downloads.
+    """
+    if req.method == 'HEAD':
+        return False
+    if status == 206:
+        return (req.get_header('Range') or '').strip().startswith('bytes=0-')
+    return status == 200
+
+def send_file(req, file, size, download, mime_type):
+    """
+    Sends content of opened <file> with <size> bytes to client. Supports
+    conditional requests and single byte ranges. File is sent in bounded
+    chunks. Returns sent HTTP status code.
+    """
+    etag = get_etag(download)
+    last_modified = http_date(download['time'])
+
+    # Client has current version of file.
+    if is_not_modified(req, etag, download['time']):
+        req.send_response(304)
+        req.send_header('ETag', etag)
+        req.send_header('Content-Length', 0)
+        req.end_headers()
+        return 304
+
+    byte_range = get_range(req, size, etag, last_modified)
+    if byte_range is False:
+        req.send_response(416)
+        req.send_header('Content-Range', 'bytes */%s' % (size,))
+        req.send_header('Content-Length', 0)
+        req.end_headers()
+        return 416
+
+    # Send headers.
+    if byte_range:
+        first, last = byte_range
+        req.send_response(206)
+        req.send_header('Content-Range', 'bytes %s-%s/%s' % (first, last, size))
+    else:
+        first, last = 0, size - 1
+        req.send_response(200)
+    req.send_header('Content-Type', mime_type)
+    req.send_header('Content-Length', last - first + 1)
+    req.send_header('Accept-Ranges', 'bytes')
+    req.send_header('ETag', etag)
+    req.send_header('Last-Modified', last_modified)
+    req.end_headers()
+
+    # Stream requested part of file.
+    if req.method != 'HEAD':
+        file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = file.read(min(chunk_size, remaining))
+            if not data:
+                break
+            req.write(data)
+            remaining -= len(data)
+    return byte_range and 206 or 200
+
+def get_offload_header(mode, path, root, prefix):
+    """
+    Returns name and value of header which instructs front-end server to send
+    file with <path> located under <root> directory. X-Sendfile header
+    contains absolute file path, X-Accel-Redirect header contains internal
+    URL consisting of <prefix> and path relative to <root>. Returns None if
+    <mode> is not supported or file is outside of <root>.
+    """
+    if mode not in offload_modes:
+        return None
+    path = os.path.normpath(path)
+    root = os.path.normpath(root)
+    if not path.startswith(root + os.sep):
+        return None
+    if mode == 'x-sendfile':
+        return 'X-Sendfile', path.encode('utf-8')
+    relative_path = path[len(root) + 1:].replace(os.sep, '/')
+    return 'X-Accel-Redirect', quote(prefix.rstrip('/').encode('utf-8')) + \
+      '/' + quote(relative_path.encode('utf-8'))
+
+def offload_file(req, header, download, mime_type):
+    """
+    Sends response which lets front-end server transfer the file according
+    to offload <header> returned by get_offload_header(). Conditional requests
+    are still answered directly. Returns HTTP status code of response which
+    front-end server sends to client, it applies requested byte range itself.
+    """
+    etag = get_etag(download)
+    last_modified = http_date(download['time'])
+    if is_not_modified(req, etag, download['time']):
+        req.send_response(304)
+        req.send_header('ETag', etag)
+        req.send_header('Content-Length', 0)
+        req.end_headers()
+        return 304
+
+    # Body is provided by front-end server which also handles ranges.
+    req.send_response(200)
+    req.send_header('Content-Type', mime_type)
+    req.send_header('ETag', etag)
+    req.send_header('Last-Modified', last_modified)
+    req.send_header(*header)
+    req.send_header('Content-Length', 0)
+    req.end_headers()
+    byte_range = get_range(req, download['size'], etag, last_modified)
+    if byte_range is False:
+        return 416
+    return byte_range and 206 or 200
@@ -3,6 +3,8 @@
 from trac.core import Component, implements
 from trac.mimeview import Context
 from trac.admin import IAdminPanelProvider
+from trac.web.chrome import add_stylesheet
+from trac.util.datefmt import format_datetime
 
 from api import DownloadsApi
 
@@ -20,8 +22,13 @@ class DownloadsWebAdmin(Component):
             yield ('downloads', 'Downloads System', 'downloads', 'Downloads')
             yield ('downloads', 'Downloads System', 'platforms', 'Platforms')
             yield ('downloads', 'Downloads System', 'types', 'Types')
+            yield ('downloads', 'Downloads System', 'stats', 'Query Statistics')
 
     def render_admin_panel(self, req, category, page, path_info):
+        # Query statistics are not processed by downloads API.
+        if page == 'stats':
+            return self._render_stats(req)
+
         # Create request context.
         context = Context.from_request(req)('downloads-admin')
 
@@ -37,3 +44,26 @@ class DownloadsWebAdmin(Component):
         # Process request and return content.
         api = self.env[DownloadsApi]
         return api.process_downloads(context)
+
+    # Internal methods.
+
+    def _render_stats(self, req):
+        req.perm.require('DOWNLOADS_ADMIN')
+        api = self.env[DownloadsApi]
+
+        # Reset statistics of this process.
+        if req.method == 'POST' and req.args.get('action') == 'reset':
+            api.query_stats.reset()
+            req.redirect(req.href.admin('downloads', 'stats'))
+
+        # Prepare template data.
+        stats = api.query_stats.to_dict()
+        data = {}
+        data['started'] = format_datetime(stats['started'])
+        data['threshold'] = api.slow_query_threshold
+        data['pages'] = sorted(stats['pages'], key = lambda page:
+          float(page['queries']) / page['requests'], reverse = True)
+        data['slow_queries'] = reversed(stats['slow_queries'])
+
+        add_stylesheet(req, 'downloads/css/admin.css')
+        return 'admin-downloads-stats.html', {'downloads' : data}
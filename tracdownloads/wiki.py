@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import re
+from weakref import WeakKeyDictionary
 
 from trac.core import Component, implements
-from trac.config import ListOption
+from trac.config import ListOption, IntOption
 from trac.mimeview import Context
 from trac.resource import Resource
 from trac.util.html import html
@@ -12,15 +13,22 @@ from trac.util.text import to_unicode, pretty_size
 from trac.wiki import IWikiSyntaxProvider, IWikiMacroProvider
 from trac.wiki.formatter import system_message
 
-from api import DownloadsApi
+from api import DownloadsApi, IDownloadChangeListener, database_context
+from cache import Cache
+from counter import DownloadsCounter
 
 class DownloadsWiki(Component):
     """
         The wiki module implements macro for downloads referencing.
     """
-    implements(IWikiSyntaxProvider, IWikiMacroProvider)
+    implements(IWikiSyntaxProvider, IWikiMacroProvider, IDownloadChangeListener)
 
-    all_fields = [ 'id', 'file', 'description', 'size', 'time', 'count', 'author', 'tags', 'component', 'version', 'platform', 'type' ]
+    default_fields = [ 'id', 'file', 'description', 'size', 'time', 'count', 'author', 'tags', 'component', 'version', 'platform', 'type' ]
+    # Checksums can be displayed but downloads can't be sorted by them.
+    all_fields = default_fields + [ 'sha256', 'md5' ]
+
+    # Permission policies which don't restrict individual downloads.
+    default_policies = ('DefaultPermissionPolicy', 'LegacyAttachmentPolicy')
 
     # Macros documentation.
     downloads_count_macro_doc = """Display count of dowloads."""
@@ -30,8 +38,34 @@ class DownloadsWiki(Component):
     custom_featured_downloads_macro_doc = """Display list of featured files with selected columns.\n\nPossible fields: %s """ % ",".join(all_fields)
 
     # Configuration options
-    visible_fields = ListOption('downloads', 'visible_fields', ','.join(all_fields),
+    visible_fields = ListOption('downloads', 'visible_fields', ','.join(default_fields),
       doc = 'List of downloads table fields that should be visible to users on downloads section.')
+    macro_cache_size = IntOption('downloads', 'macro_cache_size', 100,
+      doc = 'Number of rendered downloads lists and download counts of wiki macros kept in memory. Lists are shared'
+      ' by users with the same DOWNLOADS_VIEW permission, they are not cached if other than default'
+      ' permission policies are used. Zero disables the cache.')
+    macro_cache_ttl = IntOption('downloads', 'macro_cache_ttl', 300,
+      doc = 'Number of seconds rendered downloads lists of wiki macros are cached. Zero means no expiration.')
+    count_cache_ttl = IntOption('downloads', 'count_cache_ttl', 60,
+      doc = 'Number of seconds download counts of DownloadsCount macro are cached. Counts'
+      ' changed by other processes are visible after this time. Zero means no expiration.')
+
+    def __init__(self):
+        self.render_cache = Cache(self.macro_cache_size)
+        self.count_cache = Cache(self.macro_cache_size)
+        self.request_downloads = WeakKeyDictionary()
+        self.content_version = 0
+
+    # IDownloadChangeListener methods.
+
+    def download_created(self, context, download):
+        self._invalidate_caches()
+
+    def download_changed(self, context, download, old_download):
+        self._invalidate_caches()
+
+    def download_deleted(self, context, download):
+        self._invalidate_caches()
 
     # IWikiSyntaxProvider
     def get_link_resolvers(self):
@@ -65,49 +99,35 @@ class DownloadsWiki(Component):
 
     def expand_macro(self, formatter, name, content):
         if name == 'DownloadsCount':
-            # Create request context.
-            context = Context.from_request(formatter.req)('downloads-wiki')
-
-            # Get database access.
-            db = self.env.get_db_cnx()
-            context.cursor = db.cursor()
-
-            # Get API component.
-            api = self.env[DownloadsApi]
-
-            # Check empty macro content.
+            # Get download IDs or filenames from content, empty content or
+            # any zero ID means all downloads.
             download_ids = []
+            files = []
             if content and content.strip() != '':
-                # Get download IDs or filenames from content.
-                items = [item.strip() for item in content.split(',')]
-
-                # Resolve filenames to IDs.
-                for item in items:
+                for item in [item.strip() for item in content.split(',')]:
                     try:
                         # Try if it's download ID first.
                         download_id = int(item)
-                        if download_id:
-                            download_ids.append(download_id)
-                        else:
-                            # Any zero ID means all downloads.
-                            download_ids = []
-                            break;
                     except ValueError:
-                        # If it wasn't ID resolve filename.
-                        download_id = api.get_download_id_from_file(context,
-                          item)
-                        if download_id:
-                            download_ids.append(download_id)
-                        else:
-                            self.log.debug('Could not resolve download filename to ID.')
-
-            # Empty list mean all.
-            if len(download_ids) == 0:
-                download_ids = None
-
-            # Ask for aggregated downloads count.
-            self.log.debug(download_ids)
-            count = api.get_number_of_downloads(context, download_ids)
+                        files.append(item)
+                        continue
+                    if not download_id:
+                        download_ids = []
+                        files = []
+                        break
+                    download_ids.append(download_id)
+
+            # Sum stored counts and counts not written to database yet.
+            counts, total = self._get_download_counts(formatter,
+              download_ids, files)
+            counter = self.env[DownloadsCounter]
+            pending = counter and counter.get_pending_counts() or {}
+            if counts is None:
+                count = total + sum(pending.values())
+            else:
+                count = 0
+                for download_id, stored_count in counts.items():
+                    count += stored_count + pending.get(download_id, 0)
 
             # Return simple <span> with result.
             return html.span(to_unicode(count), class_ = "downloads_count")
@@ -117,22 +137,12 @@ class DownloadsWiki(Component):
             # Determine wiki page name.
             page_name = formatter.req.path_info[6:]
 
-            # Create request context.
-            context = Context.from_request(formatter.req)('downloads-wiki')
-
-            # Get database access.
-            db = self.env.get_db_cnx()
-            context.cursor = db.cursor()
-
-            # Get API object.
-            api = self.env[DownloadsApi]
-
             # Get form values.
-            order = context.req.args.get('order') or 'id'
-            desc = context.req.args.get('desc') or '1'
+            order = formatter.req.args.get('order') or 'id'
+            desc = formatter.req.args.get('desc') or '1'
 
             # Validate input
-            if order not in self.all_fields:
+            if order not in self.default_fields:
                 return system_message("%s: Invalid order by" % name)
             if desc not in ('0', '1'):
                 return system_message("%s: Invalid desc" % name)
@@ -142,17 +152,12 @@ class DownloadsWiki(Component):
             data['order'] = order
             data['desc'] = desc
             data['has_tags'] = self.env.is_component_enabled('tractags.api.TagEngine')
-            if name == 'ListDownloads':
-                data['downloads'] = api.get_downloads(context, order, desc)
-            else:
-                data['downloads'] = api.get_featured_downloads(context, order, desc)
             data['visible_fields'] = [(visible_field, None) for visible_field in self.visible_fields]
             data['page_name'] = page_name
 
             # Return rendered template.
-            return to_unicode(Chrome(self.env).render_template(formatter.req,
-              'wiki-downloads-list.html', {'downloads' : data}, 'text/html',
-              True))
+            return self._render_downloads_list(formatter, name, content, data,
+              name != 'ListDownloads')
         elif name == 'CustomListDownloads' or name == 'CustomFeaturedDownloads' or name == 'CustomListFeaturedDownloads':
 
             if not content:
@@ -165,22 +170,12 @@ class DownloadsWiki(Component):
             # Determine wiki page name.
             page_name = formatter.req.path_info[6:]
 
-            # Create request context.
-            context = Context.from_request(formatter.req)('downloads-wiki')
-
-            # Get database access.
-            db = self.env.get_db_cnx()
-            context.cursor = db.cursor()
-
-            # Get API object.
-            api = self.env[DownloadsApi]
-
             # Get form values.
-            order = context.req.args.get('order') or 'id'
-            desc = context.req.args.get('desc') or '1'
+            order = formatter.req.args.get('order') or 'id'
+            desc = formatter.req.args.get('desc') or '1'
 
             # Validate input
-            if order not in self.all_fields:
+            if order not in self.default_fields:
                 return system_message("%s: Invalid order by" % name)
             if desc not in ('0', '1'):
                 return system_message("%s: Invalid desc" % name)
@@ -193,10 +188,6 @@ class DownloadsWiki(Component):
             data['desc'] = desc
             data['has_tags'] = self.env.is_component_enabled('tractags.api.TagEngine')
             data['page_name'] = page_name
-            if name == 'CustomListDownloads':
-                data['downloads'] = api.get_downloads(context, order, desc)
-            else:
-                data['downloads'] = api.get_featured_downloads(context, order, desc)
             data['visible_fields'] = []
             while args:
                 arg = args.pop(0).strip()
@@ -210,29 +201,147 @@ class DownloadsWiki(Component):
                     data['visible_fields'].append((key, val))
 
             # Return rendered template.
+            return self._render_downloads_list(formatter, name, content, data,
+              name != 'CustomListDownloads')
+
+    # Internal functions
+
+    def _render_downloads_list(self, formatter, name, content, data, featured):
+        def render():
+            # Create request context.
+            context = Context.from_request(formatter.req)('downloads-wiki')
+
+            # Get API object.
+            api = self.env[DownloadsApi]
+
+            # Fill downloads of requested page and render the template.
+            with database_context(self.env, context):
+                api.fill_downloads_page(context, data, data['order'],
+                  data['desc'] == '1', featured)
             return to_unicode(Chrome(self.env).render_template(formatter.req,
               'wiki-downloads-list.html', {'downloads' : data}, 'text/html',
               True))
 
-    # Internal functions
+        # Lists which depend on permissions to individual downloads are not
+        # shared.
+        if self.macro_cache_size <= 0 or [policy for policy in
+          self.config.getlist('trac', 'permission_policies') if policy not in
+          self.default_policies]:
+            return render()
+        key = self._get_render_key(formatter, name, content, data)
+        if key is None:
+            return render()
+        return self.render_cache.get(key, render, self.macro_cache_ttl)
+
+    def _get_render_key(self, formatter, name, content, data):
+        # Rendered list depends on downloads and their counts, metadata and
+        # everything what affects the template output for the request. The
+        # template checks only DOWNLOADS_VIEW permission, it's taken from
+        # permission cache of the request. Returns None if the list shouldn't
+        # be cached.
+        req = formatter.req
+        position = self._get_page_position(formatter, data['order'])
+        if position is False:
+            return None
+        counter = self.env[DownloadsCounter]
+        return (self.content_version, counter and counter.generation,
+          self.env[DownloadsApi].metadata_generation, name, content,
+          data['page_name'], data['order'], data['desc'], position,
+          tuple(data['visible_fields']), data['has_tags'],
+          'DOWNLOADS_VIEW' in req.perm, to_unicode(getattr(req, 'tz', None)))
+
+    def _get_page_position(self, formatter, order):
+        # Returns position of requested page of the list, None for the first
+        # page. Page keys come from client, only keys of existing downloads
+        # are accepted so they can't fill the cache with junk entries. Returns
+        # False for any other key, such page is not cached.
+        req = formatter.req
+        for direction in ('before', 'after'):
+            key = req.args.get(direction)
+            if not key:
+                continue
+            context = Context.from_request(req)('downloads-wiki')
+            with database_context(self.env, context):
+                download_id = self.env[DownloadsApi].get_page_download_id(
+                  context, key, order)
+            if download_id is None:
+                return False
+            return direction, download_id
+        return None
+
+    def _get_linked_download(self, formatter, target):
+        # Returns download which download link to <target> ID or file name
+        # points to. Lookups are remembered for the rest of the request, so
+        # repeated links of a page don't query database again and results
+        # never come from other request.
+        req = formatter.req
+        downloads = self.request_downloads.get(req)
+        if downloads is None:
+            downloads = self.request_downloads[req] = {}
+        if not downloads.has_key(target):
+            # Create request context.
+            context = Context.from_request(req)('downloads-wiki')
+            api = self.env[DownloadsApi]
+            with database_context(self.env, context):
+                if target.isdigit():
+                    downloads[target] = api.get_download(context, int(target))
+                else:
+                    downloads[target] = api.get_download_by_file(context,
+                      target)
+        return downloads[target]
+
+    def _get_download_counts(self, formatter, download_ids, files):
+        # Returns dictionary of stored counts of downloads with <download_ids>
+        # and of first downloads with <files> names. If none of them is given
+        # or resolved, None and sum of stored counts of all downloads are
+        # returned instead. Counts are read by one query and kept until
+        # downloads or their counts change in this process or until they
+        # expire.
+        def retrieve():
+            # Create request context.
+            context = Context.from_request(formatter.req)('downloads-wiki')
+            api = self.env[DownloadsApi]
+            with database_context(self.env, context):
+                rows = api.get_download_counts(context, download_ids, files)
+                counts = {}
+                counts_by_file = {}
+                for download_id, file, count in rows:
+                    if download_id in download_ids:
+                        counts[download_id] = count
+                    counts_by_file.setdefault(file, (download_id, count))
+                for file in files:
+                    if counts_by_file.has_key(file):
+                        download_id, count = counts_by_file[file]
+                        counts[download_id] = count
+                    else:
+                        self.log.debug('Could not resolve download filename %s to ID.' % (file,))
+                if download_ids or counts:
+                    return counts, 0
+                return None, api.get_total_count(context)
+
+        if self.macro_cache_size <= 0:
+            return retrieve()
+        counter = self.env[DownloadsCounter]
+        return self.count_cache.get((self.content_version, counter and
+          counter.generation, tuple(download_ids), tuple(files)), retrieve,
+          self.count_cache_ttl)
+
+    def _invalidate_caches(self):
+        # Entries of older version could be still stored by renderings running
+        # concurrently in this process, they are not matched here anymore.
+        # Other processes don't see this change and keep serving their
+        # entries until they expire after macro_cache_ttl seconds.
+        self.content_version += 1
+        self.render_cache.invalidate()
+        self.count_cache.invalidate()
 
     def _download_link(self, formatter, ns, params, label):
         if ns == 'download':
             if formatter.req.perm.has_permission('DOWNLOADS_VIEW'):
-                # Create context.
-                context = Context.from_request(formatter.req)('downloads-wiki')
-                db = self.env.get_db_cnx()
-                context.cursor = db.cursor()
-
-                # Get API component.
-                api = self.env[DownloadsApi]
-                by_id = False
-                # Get download.
-                if params.strip().isdigit():
-                    download = api.get_download(context, params)
-                    by_id = True
-                else:
-                    download = api.get_download_by_file(context, params)
+                # Get download by its ID or file name.
+                by_id = params.strip().isdigit()
+                download = self._get_linked_download(formatter, by_id and
+                  params.strip() or params)
 
                 if download:
                     # Get url part to put after "[project]/downloads/"
@@ -246,7 +355,7 @@ class DownloadsWiki(Component):
                           pretty_size(download['size'])))
                     else:
                         # File exists but no permission to download it.
-                        html.a(label, href = '#', title = '%s (%s)' % (
+                        return html.a(label, href = '#', title = '%s (%s)' % (
                           download['file'], pretty_size(download['size'])),
                           class_ = 'missing')
                 else: